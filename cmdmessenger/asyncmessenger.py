@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+"""
+asyncio Messenger running over a StreamReader/StreamWriter pair
+
+The command table, params converters, decoding and callbacks are those
+of messenger.Messenger. A reader task (started on first use) reads
+whatever is available, feeds it to the parser and for each frame:
+    - resolves any wait_for (or request) futures for that command
+    - dispatches the attached callbacks (callbacks that are coroutine
+      functions are scheduled as tasks, errors are passed to on_error
+      and do not stop the reader)
+    - queues the frame for async iteration (if iterating)
+
+    reader, writer = await asyncio.open_connection(host, port)
+    m = AsyncMessenger(reader, writer, cmds)
+    args = await m.request('kAreYouReady', 'kAcknowledge', timeout=1.)
+    async for (cmd_id, args) in m:
+        ...
+
+wait_for only sees frames processed after it is called, use request
+(which waits for the reply before sending) for request/reply pairs.
+"""
+
+import asyncio
+import collections
+import functools
+
+from . import messenger
+
+
+def _scheduled(func):
+    # callback that schedules the coroutine func(*args) as a task
+    @functools.wraps(func)
+    def schedule(*args):
+        asyncio.ensure_future(func(*args))
+    return schedule
+
+
+class AsyncMessenger(messenger.Messenger):
+    def __init__(
+            self, reader, writer, cmds, fs=',', ls=';', esc='/',
+            chunk_size=4096, queue_size=1024):
+        messenger.Messenger.__init__(
+            self, None, cmds, fs, ls, esc, chunk_size)
+        self.reader = reader
+        self.writer = writer
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.waiters = collections.defaultdict(list)
+        self._queue = None
+        self._task = None
+
+    @classmethod
+    async def open_serial(cls, url, cmds, baudrate=115200, **kwargs):
+        """Open a serial port with pyserial-asyncio (serial_asyncio)"""
+        import serial_asyncio
+        reader, writer = await serial_asyncio.open_serial_connection(
+            url=url, baudrate=baudrate)
+        return cls(reader, writer, cmds, **kwargs)
+
+    # reading
+    def start(self):
+        """Start the reader task (if it is not running)"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._read_loop())
+        return self._task
+
+    async def _read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(self.chunk_size)
+                if not data:
+                    raise EOFError("Stream closed")
+                for frame in self.feed(data):
+                    await self._handle(frame)
+        except Exception as e:
+            self._fail(e)
+            if not isinstance(e, EOFError):
+                raise
+
+    async def _handle(self, frame):
+        cmd_id, args = frame
+        waiters = self.waiters.pop(cmd_id, None)
+        if waiters:
+            for f in waiters:
+                if not f.done():
+                    f.set_result(args)
+        self.dispatch(cmd_id, args)
+        if self._queue is not None:
+            await self._queue.put(frame)
+
+    def _fail(self, error):
+        # pass reader errors on to anything waiting for frames
+        for cmd_id in list(self.waiters):
+            for f in self.waiters.pop(cmd_id):
+                if not f.done():
+                    f.set_exception(error)
+        if self._queue is not None:
+            try:
+                self._queue.put_nowait(error)
+            except asyncio.QueueFull:
+                pass
+
+    def attach(self, func, index=None):
+        """As Messenger.attach, coroutine functions are run as tasks"""
+        if asyncio.iscoroutinefunction(func):
+            func = _scheduled(func)
+        return messenger.Messenger.attach(self, func, index)
+
+    def _waiter(self, index):
+        # register a future for the next index command
+        cmd_id = self.cmds[index]['id']
+        future = asyncio.get_event_loop().create_future()
+        self.waiters[cmd_id].append(future)
+        self.start()
+        return cmd_id, future
+
+    def _unwait(self, cmd_id, future):
+        if future in self.waiters.get(cmd_id, ()):
+            self.waiters[cmd_id].remove(future)
+
+    async def wait_for(self, index, timeout=None):
+        """Wait for the next index command, return its args"""
+        cmd_id, future = self._waiter(index)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._unwait(cmd_id, future)
+
+    async def request(self, index, reply, *args, timeout=None):
+        """
+        Send index(*args) and return the args of the next reply command,
+        waiting for the reply starts before sending so it cannot be missed
+        """
+        cmd_id, future = self._waiter(reply)
+        try:
+            await self.call(index, *args)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._unwait(cmd_id, future)
+
+    def __aiter__(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue(self.queue_size)
+        self.start()
+        return self
+
+    async def __anext__(self):
+        frame = await self._queue.get()
+        if isinstance(frame, EOFError):
+            raise StopAsyncIteration
+        if isinstance(frame, Exception):
+            raise frame
+        return frame
+
+    # writing
+    def write(self, data, nframes=1):
+        self.writer.write(bytes(data))
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def call(self, index, *args):
+        self.write(self.encoders[index](*args))
+        await self.writer.drain()
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self.writer.close()
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+"""
+Benchmarks over an in-memory loopback stream (no hardware needed)
+
+Measures frames/s, bytes/s and per frame latency (send -> callback) for
+every type in params.types, for multi param commands (kMultiValuePing),
+for series transfers (including from an emulated board) and
+escape/unescape throughput.
+
+    python -m cmdmessenger.benchmarks [-n 10000] [-o results.json]
+    python -m cmdmessenger.benchmarks --replay run.cap
+
+Results are also available as a dict (see benchmark) and can be saved as
+json to track regressions across releases.
+"""
+
+import json
+import os
+import platform
+import sys
+import time
+import timeit
+import warnings
+
+from . import escaping
+from . import messenger
+from . import params
+from . import stats
+from . import streams
+from . import tests
+
+
+# value sent for each param type
+values = {
+    'bool': True,
+    'int16': -1234,
+    'int32': 123456789,
+    'float': 1.25,
+    'double': -2.5,
+    'char': 'a',
+    'string': 'hello world',
+    'escaped_string': 'a,b;c/d',
+    'float_sci': 1.5E3,
+    'double_sci': -2.5E-2,
+    'byte_bool': True,
+    'byte_int16': -1234,
+    'byte_int32': 123456789,
+    'byte_float': 1.25,
+    'byte_double': -2.5,
+}
+
+
+def best_time(f, number, repeat=3):
+    """Best time (in seconds) for one call of f"""
+    return min(timeit.repeat(f, number=number, repeat=repeat)) / number
+
+
+def escape_benchmark(sizes=(4, 64, 1024, 16384, 262144), fs=',', ls=';',
+                     esc='/'):
+    """
+    Escape and unescape throughput for random payloads of each size
+    returns a list of dicts with size, escape_bps and unescape_bps
+    """
+    escaper = escaping.get_escaper(fs, ls, esc)
+    results = []
+    for size in sizes:
+        data = os.urandom(size)
+        escaped = escaper.escape(data)
+        number = max(1, 1000000 // size)
+        et = best_time(lambda: escaper.escape(data), number)
+        ut = best_time(lambda: escaper.unescape(escaped), number)
+        results.append({
+            'size': size,
+            'escape_bps': size / et,
+            'unescape_bps': size / ut,
+        })
+    return results
+
+
+def type_names():
+    """Name of each unique type in params.types (no shortcuts)"""
+    names = []
+    seen = []
+    for name in params.types:
+        if not isinstance(name, str):
+            continue
+        if any(params.types[name] is t for t in seen):
+            continue
+        seen.append(params.types[name])
+        names.append(name)
+    return names
+
+
+def loopback(cmds):
+    """Sending and receiving Messengers connected by an in-memory stream"""
+    a, b = streams.pair(timeout=0)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return messenger.Messenger(a, cmds), messenger.Messenger(b, cmds)
+
+
+def frame_benchmark(cmds, index, args, n=10000, latency_n=1000):
+    """
+    Throughput of sending n index commands (one call each) and receiving
+    them (with a callback) followed by the latency of latency_n single
+    send -> next_command round trips
+    """
+    tx, rx = loopback(cmds)
+    cmd_id = tx.cmds[index]['id']
+    received = [0]
+
+    def count(*args):
+        received[0] += 1
+
+    rx.attach(count, cmd_id)
+    nbytes = len(tx.encoders[index](*args)) * n
+    t0 = stats.clock()
+    for _ in range(n):
+        tx.call(index, *args)
+    while received[0] < n:
+        rx.next_command()
+    t = stats.clock() - t0
+    latency = stats.Histogram()
+    for _ in range(latency_n):
+        t0 = stats.clock()
+        tx.call(index, *args)
+        rx.next_command()
+        latency.add(stats.clock() - t0)
+    return {
+        'frames': n,
+        'bytes': nbytes,
+        'seconds': t,
+        'frames_per_s': n / t,
+        'bytes_per_s': nbytes / t,
+        'latency': latency.summary(),
+    }
+
+
+def type_benchmarks(n=10000, latency_n=1000):
+    """frame_benchmark of a 1 param command for every param type"""
+    results = {}
+    for name in type_names():
+        cmds = [{'name': 'kValue', 'params': [name]}]
+        results[name] = frame_benchmark(
+            cmds, 'kValue', (values[name], ), n, latency_n)
+    return results
+
+
+def multi_benchmark(n=10000, latency_n=1000):
+    """frame_benchmark of kMultiValuePing (int16, int32, double)"""
+    return frame_benchmark(
+        tests.cmds, 'kMultiValuePing', (-1234, 123456789, -2.5),
+        n, latency_n)
+
+
+def series_benchmarks(n=100000):
+    """
+    Transfer of n kReceiveSeries values (sent with call_many) received:
+        callbacks: with a callback per value
+        collect: with a (numpy) series collector
+    """
+    results = {}
+    data = [float(i) for i in range(n)]
+    for mode in ('callbacks', 'collect'):
+        tx, rx = loopback(tests.cmds)
+        received = [0]
+
+        def count(*args):
+            received[0] += 1
+
+        t0 = stats.clock()
+        tx.call_many('kReceiveSeries', data)
+        tx.call('kDoneReceiveSeries', 'done')
+        nbytes = len(tx.stream.tx)
+        if mode == 'callbacks':
+            rx.attach(count, rx.cmds['kReceiveSeries']['id'])
+            while received[0] < n:
+                rx.next_command()
+        else:
+            c = rx.collect('kReceiveSeries', 'kDoneReceiveSeries', n)
+            while not c.done.is_set():
+                rx.next_command()
+        t = stats.clock() - t0
+        results[mode] = {
+            'frames': n,
+            'bytes': nbytes,
+            'seconds': t,
+            'frames_per_s': n / t,
+            'bytes_per_s': nbytes / t,
+        }
+    return results
+
+
+def emulated_benchmark(n=10000, **kwargs):
+    """
+    kRequestSeries of n values from an emulated board (see emulator.py),
+    kwargs (baud, latency, jitter...) are passed to the Emulator
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        m = tests.emulated(**kwargs)
+    received = [0]
+
+    def count(*args):
+        received[0] += 1
+
+    m.attach(count, m.cmds['kReceiveSeries']['id'])
+    t0 = stats.clock()
+    m.call('kRequestSeries', n, 0.5)
+    while received[0] < n:
+        m.next_command()
+    t = stats.clock() - t0
+    return {
+        'frames': n,
+        'seconds': t,
+        'frames_per_s': n / t,
+    }
+
+
+def replay_benchmark(f, cmds=None, repeat=3):
+    """
+    Best of repeat replays (as fast as possible) of the received bytes in
+    a capture file (see capture.py) through a parser and callbacks
+    """
+    from . import capture
+    if cmds is None:
+        cmds = tests.cmds
+    results = []
+    for _ in range(repeat):
+        _, rx = loopback(cmds)
+        rx.attach(lambda *args: None)
+        results.append(capture.replay(f, rx))
+    return max(results, key=lambda r: r['frames_per_s'] or 0)
+
+
+def benchmark(n=10000, latency_n=1000, series_n=100000):
+    """Run all benchmarks, returns a (json serialisable) dict"""
+    from . import __version__
+    return {
+        'version': __version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'types': type_benchmarks(n, latency_n),
+        'multi': multi_benchmark(n, latency_n),
+        'series': series_benchmarks(series_n),
+        'emulated': emulated_benchmark(n),
+        'escape': escape_benchmark(),
+    }
+
+
+def run(n=10000, output=None):
+    results = benchmark(n, max(1, n // 10), n * 10)
+    print("%-16s %12s %12s %12s" % (
+        'type', 'frames/s', 'MB/s', 'p50 [us]'))
+    rows = sorted(results['types'].items())
+    rows.append(('kMultiValuePing', results['multi']))
+    for (name, r) in rows:
+        print("%-16s %12.0f %12.3f %12.1f" % (
+            name, r['frames_per_s'], r['bytes_per_s'] / 1E6,
+            r['latency']['p50'] * 1E6))
+    print("series [frames/s]")
+    for (mode, r) in sorted(results['series'].items()):
+        print("%-16s %12.0f" % (mode, r['frames_per_s']))
+    print("%-16s %12.0f" % ('emulated', results['emulated']['frames_per_s']))
+    print("escape/unescape throughput [MB/s]")
+    for r in results['escape']:
+        print("%8i: %10.1f %10.1f" % (
+            r['size'], r['escape_bps'] / 1E6, r['unescape_bps'] / 1E6))
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', type=int, default=10000)
+    parser.add_argument('-o', '--output', default=None)
+    parser.add_argument(
+        '--replay', default=None,
+        help="only replay a capture file (received bytes, tests.cmds)")
+    args = parser.parse_args(sys.argv[1:])
+    if args.replay is not None:
+        r = replay_benchmark(args.replay)
+        print("%s: %i frames %.0f frames/s %.3f MB/s" % (
+            args.replay, r['frames'], r['frames_per_s'],
+            r['bytes_per_s'] / 1E6))
+    else:
+        run(args.n, args.output)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+"""
+Chunked receive buffer sitting between a stream and the message parsing
+
+Rather than calling stream.read(1) for every byte, everything the stream
+has available (stream.in_waiting, bounded by chunk_size) is read in one
+call and appended to a reusable bytearray. Separators are then found by
+scanning the buffer with a precompiled regex so extracting a value or
+line costs O(length) with one read per burst of data.
+"""
+
+import re
+
+from . import escaping
+
+class ReadTimeout(Exception):
+    pass
+
+
+def to_bytes(s):
+    """
+    Convert a str (or bytes, bytearray, memoryview or any other buffer)
+    to bytes, latin-1 maps chars 1:1 to bytes
+    """
+    if isinstance(s, bytes):
+        return s
+    if isinstance(s, str):
+        return s.encode('latin-1')
+    # (unlike bytes(s)) raises TypeError for ints
+    return memoryview(s).tobytes()
+
+
+if str is bytes:
+    to_native = str
+else:
+    def to_native(s):
+        """Convert bytes read from the stream to a native str"""
+        if isinstance(s, str):
+            return s
+        return bytes(s).decode('latin-1')
+
+
+_patterns = {}
+
+
+def stop_pattern(stops, esc=None):
+    """Compiled (and cached) regex matching any stop byte or esc"""
+    key = (stops, esc)
+    if key not in _patterns:
+        chars = stops if esc is None else stops + esc
+        _patterns[key] = re.compile(
+            b'[' + b''.join(re.escape(chars[i:i+1])
+                            for i in range(len(chars))) + b']')
+    return _patterns[key]
+
+
+def in_waiting(stream):
+    """Number of bytes the stream has ready, 0 if this is unknown"""
+    n = getattr(stream, 'in_waiting', None)
+    if n is None:
+        f = getattr(stream, 'inWaiting', None)
+        if f is None:
+            return 0
+        n = f()
+    return n
+
+
+class ReceiveBuffer(object):
+    def __init__(self, stream, chunk_size=4096):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.pos = 0
+        self._readinto = getattr(stream, 'readinto', None)
+        if self._readinto is not None:
+            self._chunk = memoryview(bytearray(chunk_size))
+
+    def __len__(self):
+        return len(self.buffer) - self.pos
+
+    def compact(self):
+        if self.pos:
+            del self.buffer[:self.pos]
+            self.pos = 0
+
+    def fill(self):
+        """Read everything available (at least 1 byte), return n bytes read
+
+        raises ReadTimeout if the stream returned no data"""
+        n = min(max(in_waiting(self.stream), 1), self.chunk_size)
+        if self._readinto is not None:
+            # read into the preallocated chunk (the stream allocates no
+            # bytes object per read, the chunk is copied onto buffer)
+            n = self._readinto(self._chunk[:n])
+            data = self._chunk[:n or 0]
+        else:
+            data = self.stream.read(n)
+        if not data:
+            raise ReadTimeout("Stream read returned no data")
+        # only move data when the consumed portion is significant
+        if self.pos and self.pos >= len(self.buffer) // 2:
+            self.compact()
+        if isinstance(data, str):
+            data = to_bytes(data)
+        self.buffer += data
+        return len(data)
+
+    def take(self, end, esc=None):
+        """Remove and return buffer[pos:end], removing escapes if esc"""
+        s = bytes(self.buffer[self.pos:end])
+        self.pos = end
+        if esc is not None:
+            s = escaping.unescape(s, esc)
+        return s
+
+    def read_until(self, stops, esc=None, unescape=False):
+        """
+        Read up to and including the first byte in stops. If esc is
+        provided, a byte following esc is never treated as a stop. If
+        unescape is True the esc bytes are removed from the result.
+        """
+        pattern = stop_pattern(stops, esc)
+        i = self.pos
+        while True:
+            m = pattern.search(self.buffer, i)
+            if m is None:
+                i = len(self.buffer)
+                i -= self.pos
+                self.fill()
+                i += self.pos
+                continue
+            j = m.start()
+            if esc is not None and self.buffer[j:j+1] == esc:
+                # skip escaped byte, it may not have arrived yet
+                while j + 1 >= len(self.buffer):
+                    j -= self.pos
+                    self.fill()
+                    j += self.pos
+                i = j + 2
+                continue
+            return self.take(j + 1, esc if unescape else None)
+
+    def read(self, n, esc=None):
+        """Read n (unescaped) bytes, removing esc bytes if esc is provided"""
+        if esc is None:
+            while len(self) < n:
+                self.fill()
+            return self.take(self.pos + n)
+        count = 0
+        i = self.pos
+        while count < n:
+            if i >= len(self.buffer) or (
+                    self.buffer[i:i+1] == esc and i + 1 >= len(self.buffer)):
+                # need more data (possibly the byte following an esc)
+                i -= self.pos
+                self.fill()
+                i += self.pos
+                continue
+            if self.buffer[i:i+1] == esc:
+                i += 2
+                count += 1
+                continue
+            end = min(len(self.buffer), i + n - count)
+            j = self.buffer.find(esc, i, end)
+            if j == -1:
+                j = end
+            count += j - i
+            i = j
+        return self.take(i, esc)
+
+    def drain(self):
+        """Remove and return all buffered bytes"""
+        s = self.take(len(self.buffer))
+        self.compact()
+        return s
+
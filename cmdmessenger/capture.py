@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Capture of the raw bytes read and written by a Messenger and replay
+
+A capture file is a header (magic and the wall clock start time)
+followed by one record per chunk:
+    <float64 seconds since start><uint8 direction><uint32 length><data>
+where direction is RX (fed to the parser) or TX (written to the stream).
+
+Capturing is installed (like stats, see stats.Instrument) by wrapping
+the feed and write methods of the Messenger instance. The wrappers only
+timestamp the chunk and append it to a deque, a background thread writes
+records to the file so the hot path never blocks on disk.
+
+    m.start_capture('run.cap')
+    ...
+    m.stop_capture()
+
+    # feed the received bytes back through a parser and callbacks
+    m = messenger.Messenger(stream, cmds)
+    m.attach(...)
+    capture.replay('run.cap', m)  # as fast as possible
+    capture.replay('run.cap', m, realtime=True)  # original pacing
+"""
+
+import collections
+import struct
+import threading
+import time
+
+from . import stats
+
+RX = 0
+TX = 1
+
+magic = b'CMDCAP1\n'
+header = struct.Struct('<d')
+record = struct.Struct('<dBI')
+
+
+class Capture(stats.Instrument):
+    methods = ('feed', 'write')
+
+    def __init__(self, f, messenger=None, interval=0.05):
+        """f is a filename or (binary) file opened for writing"""
+        stats.Instrument.__init__(self, messenger)
+        if isinstance(f, str):
+            f = open(f, 'wb')
+        self.file = f
+        self.interval = interval
+        self.chunks = collections.deque()
+        self.start = stats.clock()
+        self.file.write(magic + header.pack(time.time()))
+        self._stop = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def flush(self):
+        """Write all queued chunks to the file"""
+        chunks = self.chunks
+        out = bytearray()
+        while chunks:
+            (t, direction, data) = chunks.popleft()
+            out += record.pack(t, direction, len(data))
+            out += data
+        if out:
+            self.file.write(out)
+            self.file.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+    def wrap_feed(self, feed):
+        chunks = self.chunks
+        clock = stats.clock
+        start = self.start
+
+        def captured_feed(data):
+            chunks.append((clock() - start, RX, bytes(data)))
+            return feed(data)
+        return captured_feed
+
+    def wrap_write(self, write):
+        chunks = self.chunks
+        clock = stats.clock
+        start = self.start
+
+        def captured_write(data, nframes=1):
+            chunks.append((clock() - start, TX, bytes(data)))
+            write(data, nframes)
+        return captured_write
+
+    def close(self):
+        self.uninstall()
+        self._stop.set()
+        self.thread.join()
+        self.flush()
+        self.file.close()
+
+
+def read(f):
+    """Generate (t, direction, data) for every record in a capture file"""
+    if isinstance(f, str):
+        with open(f, 'rb') as f:
+            for r in read(f):
+                yield r
+        return
+    h = f.read(len(magic) + header.size)
+    if h[:len(magic)] != magic:
+        raise ValueError("Not a capture file")
+    while True:
+        rh = f.read(record.size)
+        if len(rh) < record.size:
+            return
+        t, direction, n = record.unpack(rh)
+        yield t, direction, f.read(n)
+
+
+def replay(f, messenger, realtime=False, speed=1., dispatch=True):
+    """
+    Feed the received (RX) chunks of a capture through the messenger
+    parser (and callbacks if dispatch) either as fast as possible or,
+    if realtime, with the original pacing (scaled by speed).
+    Returns a dict with frames, bytes, seconds and rates.
+    """
+    feed = messenger.feed
+    trigger = messenger.trigger
+    nbytes = 0
+    nframes = 0
+    t0 = stats.clock()
+    for (t, direction, data) in read(f):
+        if direction != RX:
+            continue
+        if realtime:
+            d = t / speed - (stats.clock() - t0)
+            if d > 0:
+                time.sleep(d)
+        nbytes += len(data)
+        frames = feed(data)
+        nframes += len(frames)
+        if dispatch:
+            for (cmd_id, args) in frames:
+                trigger(cmd_id, *args)
+    t = stats.clock() - t0
+    return {
+        'frames': nframes,
+        'bytes': nbytes,
+        'seconds': t,
+        'frames_per_s': nframes / t if t else None,
+        'bytes_per_s': nbytes / t if t else None,
+    }
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""
+Precompiled per-command codecs
+
+A Decoder is compiled once per command (from the list of params.types
+entries) and converts the (bytes) fields of a received frame to python
+values. Runs of consecutive byte params (those with a struct 'fmt') are
+decoded with one precompiled struct.Struct and text params go through a
+flat tuple of converters, so no per argument dict lookups are needed.
+
+Codecs do not change once made so get_decoder and get_encoder cache and
+share them between Messengers with the same commands.
+
+An Encoder is the reverse, it holds the encoded "<id><fs>" prefix, the
+tuple of 'to' converters and which params are escaped, and encodes one
+(or many) frames of args to bytes. As cmdmessenger does, fs is only sent
+if at least one arg is encoded (a call with no args sends "<id><ls>").
+"""
+
+import struct
+
+from . import buffer
+from . import escaping
+
+
+def text_converter(ptype):
+    """Converter from a (bytes) text field to a python value"""
+    f = ptype['from']
+    native = buffer.to_native
+    return lambda s: f(native(s))
+
+
+def byte_converter(ptype):
+    """Converter from an (unescaped) binary field to a python value"""
+    return ptype['from']
+
+
+def compile_steps(ptypes):
+    """
+    Group param types into decoding steps of:
+        (start, stop, struct.Struct) for runs of byte params
+        (index, None, converter) for all other params
+    """
+    steps = []
+    i = 0
+    n = len(ptypes)
+    while i < n:
+        if 'fmt' in ptypes[i]:
+            j = i
+            while j < n and 'fmt' in ptypes[j]:
+                j += 1
+            steps.append((i, j, struct.Struct(
+                '<' + ''.join(pt['fmt'] for pt in ptypes[i:j]))))
+            i = j
+        else:
+            steps.append((i, None, text_converter(ptypes[i])))
+            i += 1
+    return tuple(steps)
+
+
+class Decoder(object):
+    def __init__(self, ptypes):
+        self.ptypes = tuple(ptypes)
+        self.nargs = len(self.ptypes)
+        self.steps = compile_steps(self.ptypes)
+        # converters used when a frame has too few fields
+        self.converters = tuple(
+            byte_converter(pt) if 'fmt' in pt else text_converter(pt)
+            for pt in self.ptypes)
+        if len(self.steps) == 1 and self.steps[0][1] is not None:
+            self.decode = self._decode_struct
+            self._struct = self.steps[0][2]
+        elif all(s[1] is None for s in self.steps):
+            self.decode = self._decode_text
+        else:
+            self.decode = self._decode_steps
+
+    def __call__(self, fields):
+        if len(fields) < self.nargs:
+            return [c(f) for (c, f) in zip(self.converters, fields)]
+        return self.decode(fields)
+
+    def _decode_struct(self, fields):
+        if self.nargs == 1:
+            return list(self._struct.unpack(fields[0]))
+        return list(self._struct.unpack(b''.join(fields[:self.nargs])))
+
+    def _decode_text(self, fields):
+        return [c(f) for (c, f) in zip(self.converters, fields)]
+
+    def _decode_steps(self, fields):
+        args = []
+        for (start, stop, f) in self.steps:
+            if stop is None:
+                args.append(f(fields[start]))
+            else:
+                args.extend(f.unpack(b''.join(fields[start:stop])))
+        return args
+
+
+class Encoder(object):
+    def __init__(self, cmd_id, ptypes, fs=b',', ls=b';', esc=b'/'):
+        self.cmd_id = cmd_id
+        self.ptypes = tuple(ptypes)
+        self.nargs = len(self.ptypes)
+        self.fs = buffer.to_bytes(fs)
+        self.ls = buffer.to_bytes(ls)
+        self.esc = buffer.to_bytes(esc)
+        self.prefix = buffer.to_bytes(str(cmd_id))
+        if self.nargs:
+            self.head = self.prefix + self.fs
+        else:
+            self.head = self.prefix
+        self.empty = self.prefix + self.ls  # frame without args
+        self.converters = tuple(pt['to'] for pt in self.ptypes)
+        self.escapes = tuple(
+            bool(pt.get('escape') or pt.get('escaped'))
+            for pt in self.ptypes)
+        self.escaper = escaping.get_escaper(self.fs, self.ls, self.esc)
+        self.escape = self.escaper.escape
+
+    def fields(self, args):
+        """Convert (and if needed escape) args to a list of bytes"""
+        fields = []
+        for (t, e, a) in zip(self.converters, self.escapes, args):
+            f = buffer.to_bytes(t(a))
+            if e:
+                f = self.escape(f)
+            fields.append(f)
+        return fields
+
+    def __call__(self, *args):
+        fields = self.fields(args)
+        if not fields:
+            return self.empty
+        return self.head + self.fs.join(fields) + self.ls
+
+    def encode_into(self, out, args):
+        """Append the encoded frame for args to bytearray out"""
+        fields = self.fields(args)
+        if not fields:
+            out += self.empty
+            return
+        out += self.head
+        out += self.fs.join(fields)
+        out += self.ls
+
+    def encode_many(self, values, out=None):
+        """
+        Encode one frame per item in values (each a tuple of args) into
+        bytearray out. For commands with 1 param values can be a
+        sequence of values or a numpy array.
+        """
+        if out is None:
+            out = bytearray()
+        if hasattr(values, 'dtype') and self.nargs == 1:
+            if self._encode_array(out, values):
+                return out
+        for args in values:
+            if not isinstance(args, (tuple, list)):
+                args = (args, )
+            self.encode_into(out, args)
+        return out
+
+    def _encode_array(self, out, values):
+        # vectorised encoding of byte params, False if not possible
+        import numpy
+        fmt = self.ptypes[0].get('fmt', None)
+        if fmt is None:
+            return False
+        values = numpy.asarray(values).ravel()
+        wire = numpy.dtype('<' + fmt)
+        if not _fits(numpy, values, wire):
+            # the per value path raises the same errors as __call__
+            return False
+        nh = len(self.head)
+        records = numpy.empty(len(values), dtype=[
+            ('head', 'S%i' % nh), ('value', wire),
+            ('ls', 'S%i' % len(self.ls))])
+        records['head'] = self.head
+        records['value'] = values
+        records['ls'] = self.ls
+        encoded = records.view('u1').reshape(len(values), -1)
+        special = numpy.frombuffer(self.escaper.specials, dtype='u1')
+        mask = numpy.zeros(encoded.shape, dtype=bool)
+        mask[:, nh:nh + wire.itemsize] = numpy.isin(
+            encoded[:, nh:nh + wire.itemsize], special)
+        if mask.any():
+            # insert an esc before every value byte that needs it
+            encoded = numpy.insert(
+                encoded.ravel(), numpy.flatnonzero(mask), ord(self.esc))
+        out += encoded.tobytes()
+        return True
+
+
+def _fits(numpy, values, wire):
+    # True if values can be cast to wire without the wrapping,
+    # truncation or overflow that struct.pack would refuse
+    kind = values.dtype.kind
+    if wire.kind == 'b':
+        return kind in 'biuf'
+    if wire.kind == 'i':
+        if kind not in 'biu':
+            return False
+        if not len(values) or kind == 'b':
+            return True
+        info = numpy.iinfo(wire)
+        return values.min() >= info.min and values.max() <= info.max
+    if kind not in 'biuf':
+        return False
+    with numpy.errstate(over='ignore'):
+        cast = values.astype(wire)
+    return not numpy.any(numpy.isinf(cast) & numpy.isfinite(values))
+
+
+_decoders = {}
+_encoders = {}
+
+
+def get_decoder(ptypes):
+    """Cached Decoder for a list of params.types entries"""
+    # entries are kept alive by the cached codec so their ids are unique
+    key = tuple(id(pt) for pt in ptypes)
+    decoder = _decoders.get(key, None)
+    if decoder is None:
+        decoder = _decoders[key] = Decoder(ptypes)
+    return decoder
+
+
+def get_encoder(cmd_id, ptypes, fs=b',', ls=b';', esc=b'/'):
+    """Cached Encoder for a command"""
+    key = (cmd_id, tuple(id(pt) for pt in ptypes), fs, ls, esc)
+    encoder = _encoders.get(key, None)
+    if encoder is None:
+        encoder = _encoders[key] = Encoder(cmd_id, ptypes, fs, ls, esc)
+    return encoder
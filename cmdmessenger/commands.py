@@ -2,6 +2,7 @@
 """
 """
 
+from . import buffer
 from . import params
 
 
@@ -25,6 +26,59 @@ def validate(cmd):
     return True
 
 
+def resolve_converter(t):
+    """
+    Converter for a params.types name (from arduino) or a callable (used
+    as given, so bool, int... are called as python types)
+    """
+    if callable(t):
+        return t
+    return params.types[t]['from']
+
+
+_callback_factories = {}
+
+_callback_template = """
+def factory(func):
+    def call(*args):
+        try:
+            %(args)s, = args
+        except ValueError:
+            raise ValueError(
+                "Invalid number of arguments %%s != %(n)s" %% len(args))
+        return func(%(converted)s)
+    return call
+"""
+
+
+def callback_factory(converters):
+    """
+    Generate (and cache per tuple of converters) a function that wraps
+    a callback func so it is called with converted arguments:
+        callback_factory((int, float))(func)('1', '2.') -> func(1, 2.)
+    """
+    factory = _callback_factories.get(converters, None)
+    if factory is not None:
+        return factory
+    n = len(converters)
+    if n == 0:
+        def factory(func):
+            def call(*args):
+                return func()
+            return call
+    else:
+        namespace = dict(('c%i' % i, c) for (i, c) in enumerate(converters))
+        src = _callback_template % {
+            'n': n,
+            'args': ', '.join('a%i' % i for i in range(n)),
+            'converted': ', '.join('c%i(a%i)' % (i, i) for i in range(n)),
+        }
+        exec(compile(src, '<callback%s>' % n, 'exec'), namespace)
+        factory = namespace['factory']
+    _callback_factories[converters] = factory
+    return factory
+
+
 class Callback(object):
     """
     Callbacks are called when a command message is received from the arduino
@@ -35,39 +89,137 @@ class Callback(object):
         self.types = types
         if types is None:
             self.nargs = 0
+            self.converters = ()
         else:
             self.nargs = len(self.types)
+            self.converters = tuple(resolve_converter(t) for t in types)
         self.func = func
+        self.call = callback_factory(self.converters)(func)
 
     def __call__(self, *args):
-        if self.nargs == 0:
-            self.func()
-        else:
-            # convert args
-            if len(args) != self.nargs:
-                raise ValueError(
-                    "Invalid number of arguments %s != %s"
-                    % (len(args), self.nargs))
-            self.func(*[t(a) for (t, a) in zip(self.types, args)])
+        return self.call(*args)
 
 
 def make_callback(callback):
+    """
+    Make a callable (with argument conversion and count checking) from
+    a Callback, dict (with function and params) or function. The wrapper
+    is generated once per tuple of converters (see callback_factory)
+    """
     if isinstance(callback, Callback):
-        return callback
+        return callback.call
     if isinstance(callback, dict):
-        return Callback(callback['function'], callback['params'])
-    return Callback(func=callback)
+        return Callback(callback['function'], callback.get('params')).call
+    return Callback(func=callback).call
+
+
+_command_factories = {}
+
+_command_template = """
+def %(factory)s(messenger, head, fs, ls, escape, empty%(names)s):
+    def cmd(%(args)s):
+%(body)s
+    return cmd
+"""
+
+# default of args left out of a command stub
+missing = object()
+
+
+def command_signature(encoder):
+    """Commands with the same signature share a command factory"""
+    return tuple(
+        ('fmt' in pt, e) for (pt, e) in zip(encoder.ptypes, encoder.escapes))
+
+
+def command_source(signature, factory='factory'):
+    """
+    Source of a command factory (see make_command) for a signature, a
+    tuple of (byte param, escaped) for each param. Like codec.Encoder,
+    trailing args can be left out (sending "<id><ls>" without args).
+    """
+    fields = []
+    for (i, (is_bytes, e)) in enumerate(signature):
+        if is_bytes:  # byte params are converted to bytes
+            f = 'c%i(a%i)' % (i, i)
+        else:
+            f = 'to_bytes(c%i(a%i))' % (i, i)
+        if e:
+            f = 'escape(%s)' % f
+        fields.append(f + ' + ')
+    n = len(signature)
+    body = []
+    for i in range(n):
+        if i == 0:
+            frame = 'empty'
+        else:
+            frame = 'head + %sls' % 'fs + '.join(fields[:i])
+        body.append(
+            '        if a%i is missing:\n'
+            '            return messenger.write(%s)\n' % (i, frame))
+    body.append(
+        '        return messenger.write(head + %sls)' % 'fs + '.join(fields))
+    return _command_template % {
+        'factory': factory,
+        'names': ''.join(', c%i' % i for i in range(n)),
+        'args': ', '.join('a%i=missing' % i for i in range(n)),
+        'body': ''.join(body),
+    }
+
+
+def command_factory(signature):
+    """Generate (and cache per signature) a command factory"""
+    factory = _command_factories.get(signature, None)
+    if factory is None:
+        namespace = {'to_bytes': buffer.to_bytes, 'missing': missing}
+        exec(compile(
+            command_source(signature), '<command factory>', 'exec'),
+            namespace)
+        factory = _command_factories[signature] = namespace['factory']
+    return factory
 
 
-def make_command(send=None, cmd_id=None, types=None):
-    def cmd(*args):
-        send(cmd_id, *[
-            params.types[t]['to'](a) for (t, a) in zip(types, args)])
+def make_command(messenger, encoder, name='cmd', factory=None):
+    """
+    Make a function that sends a command with messenger.write.
+    The encoded "<id><fs>" prefix, the 'to' converters and escaping
+    (from a codec.Encoder) are bound in so a call only formats the
+    args and writes.
+    """
+    if factory is None:
+        factory = command_factory(command_signature(encoder))
+    cmd = factory(
+        messenger, encoder.head, encoder.fs, encoder.ls, encoder.escape,
+        encoder.empty, *encoder.converters)
+    cmd.__name__ = name
+    return cmd
 
 
 class Namespace(object):
-    def __init__(self, commands, send):
-        for cmd in commands:
-            if 'name' in cmd:
-                setattr(cmd['name'], make_command(
-                    send, cmd['id'], cmd['params']))
+    """
+    Attribute access to commands by name:
+        m.cmd.kValuePing(3, x)
+    Command stubs are made on first access (and kept)
+    """
+    def __init__(self, messenger, encoders, factories=None):
+        """
+        encoders is a dict of name: codec.Encoder, factories an optional
+        dict of name: command factory (for example from a compiled table)
+        """
+        self._messenger = messenger
+        self._encoders = encoders
+        self._factories = {} if factories is None else factories
+
+    def __getattr__(self, name):
+        encoder = None
+        if not name.startswith('_'):
+            encoder = self._encoders.get(name, None)
+        if encoder is None:
+            raise AttributeError("No command %s" % (name, ))
+        cmd = make_command(
+            self._messenger, encoder, name, self._factories.get(name, None))
+        setattr(self, name, cmd)
+        return cmd
+
+    def __dir__(self):
+        return sorted(n for n in self._encoders if isinstance(n, str))
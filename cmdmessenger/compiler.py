@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""
+Compile declarative command tables into cached codec modules
+
+A spec is a dict (or json file) with the separators and the commands:
+    {"fs": ",", "ls": ";", "esc": "/", "commands": [
+        {"name": "kAcknowledge", "params": ["s"]},
+        {"name": "kValuePing", "params": ["i16", "bf"],
+         "reply": "kValuePong"},
+        ...]}
+(a plain list of commands uses the default separators). Command names
+can also be read (in id order) from the enum of an arduino sketch with
+parse_enum, params and replies are then given by name.
+
+A spec is validated once and compiled into a python module with a
+specialised command factory (see commands.py) and decode function per
+command. The module is written to a cache directory (default
+~/.cache/cmdmessenger or $CMDMESSENGER_CACHE) keyed by a hash of the
+spec so later loads (in any process) only import it. A loaded module is
+wrapped in a Table (with the resolved commands, codecs and parser
+layouts) made once per process and shared by every Messenger using it,
+so making a Messenger from a compiled table does no per command work:
+
+    m = Messenger.from_spec(stream, 'commands.json')
+"""
+
+import hashlib
+import importlib.util
+import json
+import os
+import re
+
+from . import buffer
+from . import codec
+from . import commands
+from . import messenger
+from . import params
+from . import parser
+
+# bump when the generated code changes
+version = 2
+
+_tables = {}  # spec hash: Table
+_files = {}  # (json filename, mtime, size): spec hash
+_type_names = {}
+
+
+def default_cache_dir():
+    return os.environ.get(
+        'CMDMESSENGER_CACHE',
+        os.path.join(os.path.expanduser('~'), '.cache', 'cmdmessenger'))
+
+
+def parse_enum(source, name=None):
+    """
+    Command names (in id order) from an enum in arduino source, the first
+    enum or the one called name. Ids without a name (from explicit
+    values) are None.
+    """
+    source = re.sub(r'//[^\n]*|/\*.*?\*/', '', source, flags=re.S)
+    for m in re.finditer(r'\benum\s*(\w*)\s*\{([^}]*)\}', source):
+        if name is not None and m.group(1) != name:
+            continue
+        names = []
+        for entry in m.group(2).split(','):
+            entry = entry.strip()
+            if not entry:
+                continue
+            if '=' in entry:
+                entry, value = [s.strip() for s in entry.split('=', 1)]
+                value = int(value, 0)
+                if value < len(names):
+                    raise ValueError(
+                        "Enum value %s for %s is not increasing" % (
+                            value, entry))
+                names.extend([None] * (value - len(names)))
+            names.append(entry)
+        return names
+    raise ValueError("No enum %sfound" % ('' if name is None else name + ' '))
+
+
+def from_enum(source, params=None, replies=None, name=None, **separators):
+    """
+    Spec from the command enum in arduino source (or a sketch filename),
+    params and replies are dicts of command name: param types / reply
+    """
+    if '{' not in source and os.path.exists(source):
+        with open(source) as f:
+            source = f.read()
+    params = params or {}
+    replies = replies or {}
+    cmds = []
+    for n in parse_enum(source, name):
+        c = {}
+        if n is not None:
+            c['name'] = n
+            if n in params:
+                c['params'] = list(params[n])
+            if n in replies:
+                c['reply'] = replies[n]
+        cmds.append(c)
+    spec = {'commands': cmds}
+    spec.update(separators)
+    return spec
+
+
+def type_name(t):
+    """Name of a param type given by name, shortcut or python type"""
+    if t in _type_names:
+        return _type_names[t]
+    if t not in params.types:
+        raise messenger.InvalidCommand("Unknown param type %s" % (t, ))
+    for name in params.types:
+        if isinstance(name, str) and params.types[name] is params.types[t]:
+            _type_names[t] = name
+            return name
+
+
+def load_spec(spec):
+    """
+    Normalise a spec (a dict, a list of commands or a json filename) to
+    a dict with fs, ls, esc and commands (a list of dicts)
+    """
+    if isinstance(spec, str):
+        with open(spec) as f:
+            spec = json.load(f)
+    if isinstance(spec, (list, tuple)):
+        spec = {'commands': spec}
+    cmds = []
+    for c in spec['commands']:
+        if isinstance(c, str):
+            c = {'name': c}
+        c = dict(c)
+        if 'params' in c:
+            c['params'] = [type_name(p) for p in c['params']]
+        cmds.append(c)
+    return {
+        'fs': spec.get('fs', ','),
+        'ls': spec.get('ls', ';'),
+        'esc': spec.get('esc', '/'),
+        'commands': cmds,
+    }
+
+
+def spec_hash(spec):
+    """Hash of a (normalised) spec and the compiler version"""
+    from . import __version__
+    data = json.dumps([version, __version__, spec], sort_keys=True)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+
+def validate(spec):
+    """Validate a (normalised) spec, warning about lossy param types"""
+    cmds = spec['commands']
+    messenger.validate_command(cmds)
+    names = set(c['name'] for c in cmds if 'name' in c)
+    for c in cmds:
+        for p in c.get('params', []):
+            messenger.check_pt(p)
+        if 'reply' in c and c['reply'] not in names:
+            raise messenger.InvalidCommand(
+                "Command %s unknown reply %s" % (c, c['reply']))
+
+
+def decoder_source(cmd_id, names):
+    """
+    Source of a decode function for a command with the named param
+    types (runs of byte params are unpacked with one struct)
+    """
+    ptypes = [params.types[n] for n in names]
+    lines = []
+    items = []
+    for (start, stop, _) in codec.compile_steps(ptypes):
+        if stop is None:
+            c = 'f%i_%i' % (cmd_id, start)
+            lines.append("%s = types[%r]['from']" % (c, names[start]))
+            items.append('%s(native(fields[%i]))' % (c, start))
+        else:
+            s = 's%i_%i' % (cmd_id, start)
+            lines.append("%s = struct.Struct(%r)" % (
+                s, '<' + ''.join(pt['fmt'] for pt in ptypes[start:stop])))
+            if stop - start == 1:
+                items.append('*%s.unpack(fields[%i])' % (s, start))
+            else:
+                items.append("*%s.unpack(b''.join(fields[%i:%i]))" % (
+                    s, start, stop))
+    lines.append('')
+    lines.append('')
+    lines.append('def decode_%i(fields):' % cmd_id)
+    if len(items) > 1:
+        lines.append('    return [')
+        lines.extend('        %s,' % i for i in items)
+        lines.append('    ]')
+    else:
+        lines.append('    return [%s]' % ''.join(items))
+    return '\n'.join(lines)
+
+
+_module_header = '''"""
+Compiled cmdmessenger command table (generated by cmdmessenger.compiler,
+do not edit)
+"""
+
+import struct
+
+from cmdmessenger import buffer
+from cmdmessenger import commands
+from cmdmessenger import params
+
+spec_hash = %(hash)r
+spec = %(spec)r
+fs = spec['fs']
+ls = spec['ls']
+esc = spec['esc']
+cmds = spec['commands']
+
+to_bytes = buffer.to_bytes
+missing = commands.missing
+native = buffer.to_native
+types = params.types
+'''
+
+
+def generate(spec):
+    """Source of the compiled module for a spec"""
+    spec = load_spec(spec)
+    sections = [_module_header % {'hash': spec_hash(spec), 'spec': spec}]
+    # one command factory per signature
+    signatures = {}
+    factories = []
+    decoders = []
+    for (i, c) in enumerate(spec['commands']):
+        names = c.get('params', [])
+        ptypes = [params.types[n] for n in names]
+        signature = tuple(
+            ('fmt' in pt, bool(pt.get('escape') or pt.get('escaped')))
+            for pt in ptypes)
+        if signature not in signatures:
+            signatures[signature] = 'command_factory_%i' % len(signatures)
+            sections.append(commands.command_source(
+                signature, signatures[signature]))
+        if 'name' in c:
+            factories.append((c['name'], signatures[signature]))
+        if names:
+            sections.append(decoder_source(i, names))
+            decoders.append(i)
+    sections.append('command_factories = {\n%s}\n' % ''.join(
+        '    %r: %s,\n' % f for f in factories))
+    sections.append('decoders = {\n%s}\n' % ''.join(
+        '    %i: decode_%i,\n' % (i, i) for i in decoders))
+    return '\n\n'.join(s.strip('\n') + '\n' for s in sections)
+
+
+class Table(object):
+    """
+    A compiled module with the resolved commands (as Messenger.cmds),
+    codecs (using the generated decode functions) and parser layouts
+    """
+    def __init__(self, module):
+        self.module = module
+        self.spec_hash = module.spec_hash
+        self.fs = module.fs
+        self.ls = module.ls
+        self.esc = module.esc
+        self.commands = module.cmds
+        self.command_factories = module.command_factories
+        fs = buffer.to_bytes(self.fs)
+        ls = buffer.to_bytes(self.ls)
+        esc = buffer.to_bytes(self.esc)
+        self.cmds = {}
+        self.decoders = {}
+        self.encoders = {}
+        self.layouts = {}
+        for (i, c) in enumerate(self.commands):
+            c = dict(c)
+            c['id'] = i
+            ptypes = [params.types[p] for p in c.get('params', [])]
+            if 'params' in c:
+                c['params'] = ptypes
+            decoder = codec.Decoder(ptypes)
+            if i in module.decoders:
+                decoder.decode = module.decoders[i]
+            self.decoders[i] = decoder
+            self.encoders[i] = codec.Encoder(i, ptypes, fs, ls, esc)
+            self.layouts[i] = parser.param_layout(ptypes)
+            self.cmds[i] = c
+            if 'name' in c:
+                self.cmds[c['name']] = c
+                self.encoders[c['name']] = self.encoders[i]
+
+
+def compile_table(spec, cache_dir=None):
+    """
+    Table for a spec, the module is generated (and validated) only if it
+    is not already cached on disk (or loaded in this process)
+    """
+    key = None
+    if isinstance(spec, str):
+        # json files are only read and hashed again when they change
+        st = os.stat(spec)
+        key = (os.path.abspath(spec), st.st_mtime, st.st_size)
+        if _files.get(key, None) in _tables:
+            return _tables[_files[key]]
+    spec = load_spec(spec)
+    h = spec_hash(spec)
+    if key is not None:
+        _files[key] = h
+    if h in _tables:
+        return _tables[h]
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    path = os.path.join(cache_dir, 'cmdmessenger_table_%s.py' % h)
+    if not os.path.exists(path):
+        validate(spec)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        tmp = '%s.%i.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(generate(spec))
+        os.replace(tmp, path)
+    module_spec = importlib.util.spec_from_file_location(
+        'cmdmessenger_table_%s' % h, path)
+    module = importlib.util.module_from_spec(module_spec)
+    module_spec.loader.exec_module(module)
+    table = _tables[h] = Table(module)
+    return table
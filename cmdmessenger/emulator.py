@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+"""
+In-process emulation of an arduino running CmdMessengerTest.ino
+
+The emulator implements the tests.cmds command set with the same on wire
+encoding (it is itself a Messenger on the other end of the stream):
+    kAreYouReady -> kAcknowledge
+    kAskUsIfReady -> kAreYouReady, kAcknowledge -> kYouAreReady
+    kValuePing -> kValuePong (value echoed)
+    kMultiValuePing -> kMultiValuePong (values echoed)
+    kRequestReset -> kRequestResetAcknowledge
+    kRequestSeries(n, m) -> n x kReceiveSeries(i * m), kDoneReceiveSeries
+    kPrepareSendSeries(n), n x kSendSeries -> kAckSendSeries
+    unknown commands -> kError
+    commands whose handler raises -> kError (counted in errors)
+
+Replies can be paced to a baud rate (10 bits per byte) and delayed by a
+latency (+- uniform jitter) per command, and bytes can be corrupted with
+a given probability to test error handling.
+
+In memory:
+    a, b = streams.pair(timeout=1.)
+    emulator.Emulator(b, baud=115200).start()
+    m = messenger.Messenger(a, tests.cmds)
+
+Over a pty (for anything that opens a serial port by path):
+    e, path = emulator.Emulator.pty(baud=115200)
+    e.start()
+    m = messenger.Messenger(serial.Serial(path, 115200), tests.cmds)
+"""
+
+import os
+import random
+import threading
+import time
+import warnings
+
+from . import buffer
+from . import messenger
+from . import streams
+from . import tests
+
+
+class Emulator(object):
+    def __init__(self, stream, cmds=None, baud=None, latency=0.,
+                 jitter=0., corrupt=0., seed=None):
+        if cmds is None:
+            cmds = tests.cmds
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            self.messenger = messenger.Messenger(stream, cmds)
+        # all writes go through the emulator for pacing and corruption
+        self._write = self.messenger.write
+        self.messenger.write = self.write
+        self.baud = baud
+        self.latency = latency
+        self.jitter = jitter
+        self.corrupt = corrupt
+        self.random = random.Random(seed)
+        self._next_write = 0.
+        self._series_left = 0
+        self.errors = 0
+        self.error = None  # last exception raised by a handler or read
+        self._running = threading.Event()
+        self.thread = None
+        self.handlers = {
+            'kAreYouReady': self.on_are_you_ready,
+            'kAskUsIfReady': self.on_ask_us_if_ready,
+            'kAcknowledge': self.on_acknowledge,
+            'kValuePing': self.on_value_ping,
+            'kMultiValuePing': self.on_multi_value_ping,
+            'kRequestReset': self.on_request_reset,
+            'kRequestSeries': self.on_request_series,
+            'kPrepareSendSeries': self.on_prepare_send_series,
+            'kSendSeries': self.on_send_series,
+        }
+        m = self.messenger
+        for i in range(len(cmds)):
+            name = m.cmds[i].get('name', None)
+            m.attach(self._handler(self.handlers.get(name, None)), i)
+        m.unknown = self._handler(None)
+        self._asked = False
+
+    @classmethod
+    def pty(cls, **kwargs):
+        """Emulator on the master side of a new pty, returns (e, path)"""
+        import tty
+        master, slave = os.openpty()
+        tty.setraw(master)
+        tty.setraw(slave)
+        e = cls(streams.FdStream(master, timeout=0.1), **kwargs)
+        e.slave = slave  # keep open so the master does not error
+        return e, os.ttyname(slave)
+
+    def _handler(self, f):
+        def handler(*args):
+            if self.latency or self.jitter:
+                d = self.latency + self.random.uniform(
+                    -self.jitter, self.jitter)
+                if d > 0:
+                    time.sleep(d)
+            if f is None:
+                self.send('kError', 'Command without attached callback')
+                return
+            try:
+                f(*args)
+            except Exception as e:
+                # like the firmware, reply an error and keep running
+                self.errors += 1
+                self.error = e
+                self.send('kError', 'Command failed')
+        return handler
+
+    # writing
+    def write(self, data, nframes=1):
+        if self.corrupt:
+            data = self.corrupt_bytes(data)
+        if self.baud:
+            # wait until the previous write would have been sent
+            now = time.time()
+            if self._next_write > now:
+                time.sleep(self._next_write - now)
+            self._next_write = max(now, self._next_write) + \
+                len(data) * 10. / self.baud
+        self._write(data, nframes)
+
+    def corrupt_bytes(self, data):
+        """Replace each byte with a random byte with probability corrupt"""
+        data = bytearray(data)
+        i = int(self.random.expovariate(self.corrupt))
+        while i < len(data):
+            data[i] = self.random.randint(0, 255)
+            i += 1 + int(self.random.expovariate(self.corrupt))
+        return data
+
+    def send(self, index, *args):
+        self.messenger.call(index, *args)
+
+    # command handlers
+    def on_are_you_ready(self, *args):
+        self.send('kAcknowledge', 'Arduino ready')
+
+    def on_ask_us_if_ready(self, *args):
+        self._asked = True
+        self.send('kAreYouReady', 'Asking PC if ready')
+
+    def on_acknowledge(self, *args):
+        if self._asked:
+            self._asked = False
+            self.send('kYouAreReady', True)
+
+    def on_value_ping(self, value_type, value=''):
+        # value is echoed as received (escapes included)
+        self.send('kValuePong', value)
+
+    def on_multi_value_ping(self, *args):
+        self.send('kMultiValuePong', *args)
+
+    def on_request_reset(self, *args):
+        self._series_left = 0
+        self.send('kRequestResetAcknowledge', '')
+
+    def on_request_series(self, n, multiplier):
+        self.messenger.call_many(
+            'kReceiveSeries', [i * multiplier for i in range(n)])
+        self.send('kDoneReceiveSeries', '')
+
+    def on_prepare_send_series(self, n):
+        self._series_left = n
+
+    def on_send_series(self, value):
+        if self._series_left > 0:
+            self._series_left -= 1
+            if self._series_left == 0:
+                self.send('kAckSendSeries', 'Received series')
+
+    # running
+    def start(self):
+        self._running.set()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def run(self):
+        while self._running.is_set():
+            try:
+                self.messenger.next_command()
+            except buffer.ReadTimeout:
+                pass
+            except Exception as e:
+                self.errors += 1
+                self.error = e
+                time.sleep(0.01)  # do not spin on a broken stream
+
+    def stop(self):
+        self._running.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
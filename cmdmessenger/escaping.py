@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Escaping and unescaping of params
+
+The field separator, line separator, escape character and null are
+escaped by prefixing them with the escape character. This is the single
+implementation used for sending, parsing and by the tests.
+
+Rather than walking the data one character at a time:
+    - escape uses one bulk replace per special character (escape first)
+    - unescape splits on the escape character and rejoins the parts
+Both work on bytes, bytearray, memoryview (returning bytes) and str.
+Tables are cached per (fs, ls, esc).
+
+See benchmarks.escape_benchmark for throughput vs payload size.
+"""
+
+from . import buffer
+
+
+class Escaper(object):
+    def __init__(self, fs=b',', ls=b';', esc=b'/'):
+        self.fs = buffer.to_bytes(fs)
+        self.ls = buffer.to_bytes(ls)
+        self.esc = buffer.to_bytes(esc)
+        # the escape character must be escaped first
+        specials = []
+        for c in (self.esc, self.fs, self.ls, b'\x00'):
+            if c not in specials:
+                specials.append(c)
+        self.specials = b''.join(specials)
+        self.table = tuple((c, self.esc + c) for c in specials)
+        self.native_esc = buffer.to_native(self.esc)
+        self.native_table = tuple(
+            (buffer.to_native(a), buffer.to_native(b)) for (a, b) in self.table)
+
+    def escape(self, data):
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        table = self.table
+        if not isinstance(data, (bytes, bytearray)):
+            table = self.native_table
+        for (c, r) in table:
+            if c in data:
+                data = data.replace(c, r)
+        return data
+
+    def unescape(self, data):
+        return unescape(data, self.esc)
+
+
+def unescape(data, esc=b'/'):
+    """Remove esc characters, keeping the character following each esc"""
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    if not isinstance(data, (bytes, bytearray)):
+        esc = buffer.to_native(esc)
+    if esc not in data:
+        return data
+    parts = data.split(esc)
+    out = [parts[0]]
+    i = 1
+    n = len(parts)
+    while i < n:
+        p = parts[i]
+        if p:
+            out.append(p)
+            i += 1
+        else:
+            # an escaped esc, or a trailing esc (which is dropped)
+            if i + 1 < n:
+                out.append(esc)
+                out.append(parts[i + 1])
+            i += 2
+    return data[:0].join(out)
+
+
+_escapers = {}
+
+
+def get_escaper(fs=b',', ls=b';', esc=b'/'):
+    """Cached Escaper for this (fs, ls, esc)"""
+    key = (buffer.to_bytes(fs), buffer.to_bytes(ls), buffer.to_bytes(esc))
+    if key not in _escapers:
+        _escapers[key] = Escaper(*key)
+    return _escapers[key]
+
+
+def escape(data, fs=b',', ls=b';', esc=b'/'):
+    return get_escaper(fs, ls, esc).escape(data)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+"""
+Windowed pipelining of acknowledged commands
+
+Rather than stop-and-wait (send a command, wait for its ack, send the
+next) up to size commands are kept in flight so throughput is set by the
+link bandwidth rather than the round trip time.
+
+CmdMessenger frames carry no sequence numbers so acks are matched in
+order: an ack (for example kAcknowledge) completes the oldest outstanding
+request waiting for that ack. A request that is not acked within timeout
+is sent again (up to retries times) and then fails with AckTimeout. Acks
+that match no request (for example the late ack of a retransmitted
+request) are counted as unmatched.
+
+    w = m.window(size=8)
+    requests = [w.send('kAreYouReady', 'kAcknowledge') for _ in range(100)]
+    w.flush()
+    requests[0].result -> ('Arduino ready', )
+
+    # the series protocol: kPrepareSendSeries, n x kSendSeries then one
+    # kAckSendSeries, several series can be in flight
+    w.series(values)
+
+If the messenger has no reader (see Messenger.start_reader) the window
+reads (with Messenger.poll, so waits are bounded by the timeout whatever
+the stream timeout) while waiting for acks, otherwise (or with
+pump=False, for example when a MessengerHub reads) it waits for the
+reader to dispatch the acks.
+"""
+
+import collections
+import threading
+
+from . import stats
+
+
+class AckTimeout(Exception):
+    pass
+
+
+class Request(object):
+    def __init__(self, window, ack_id, data, nframes=1):
+        self.window = window
+        self.ack_id = ack_id
+        self.data = data
+        self.nframes = nframes
+        self.sent = None
+        self.deadline = None
+        self.tries = 0
+        self.result = None  # args of the ack
+        self.error = None
+        self.done = threading.Event()
+
+    def wait(self, timeout=None):
+        """Wait for the ack, returns the ack args (raises AckTimeout)"""
+        if not self.window.wait_until(self.done.is_set, timeout):
+            raise AckTimeout("Timed out waiting for ack")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Window(object):
+    def __init__(self, messenger, size=8, timeout=1., retries=3, pump=None):
+        self.messenger = messenger
+        self.size = size  # max requests in flight
+        self.timeout = timeout
+        self.retries = retries
+        self.pump = pump
+        self.inflight = []  # in send order
+        self.pending = {}  # ack_id: deque of requests
+        self.handles = {}  # ack_id: callback handle
+        self.condition = threading.Condition()
+        self.clear()
+
+    def clear(self):
+        self.sent = 0
+        self.acked = 0
+        self.retransmits = 0
+        self.failed = 0
+        self.unmatched = 0
+        self.rtt = stats.Histogram()
+
+    def _watch(self, ack_id):
+        if ack_id in self.handles:
+            return
+        self.pending[ack_id] = collections.deque()
+
+        def on_ack(*args):
+            self._on_ack(ack_id, args)
+        self.handles[ack_id] = self.messenger.attach(on_ack, ack_id)
+
+    def _on_ack(self, ack_id, args):
+        with self.condition:
+            q = self.pending[ack_id]
+            if not q:
+                self.unmatched += 1
+                return
+            r = q.popleft()
+            self.inflight.remove(r)
+            self.acked += 1
+            self.rtt.add(stats.clock() - r.sent)
+            r.result = args
+            r.done.set()
+            self.condition.notify_all()
+
+    def _write(self, r):
+        r.tries += 1
+        r.sent = stats.clock()
+        r.deadline = r.sent + self.timeout
+        self.messenger.write(r.data, r.nframes)
+
+    def check(self):
+        """Resend (or fail) requests that were not acked in time"""
+        now = stats.clock()
+        with self.condition:
+            for r in list(self.inflight):
+                if now < r.deadline:
+                    continue
+                if r.tries <= self.retries:
+                    self.retransmits += 1
+                    self._write(r)
+                    continue
+                self.inflight.remove(r)
+                self.pending[r.ack_id].remove(r)
+                self.failed += 1
+                r.error = AckTimeout(
+                    "No ack after %i tries" % (r.tries, ))
+                r.done.set()
+                self.condition.notify_all()
+
+    def service(self, timeout=None):
+        """Read (or wait for) acks for up to about timeout then check"""
+        pump = self.pump
+        if pump is None:
+            pump = self.messenger.read_thread is None
+        if pump:
+            self.messenger.poll(timeout)
+        else:
+            with self.condition:
+                self.condition.wait(timeout)
+        self.check()
+
+    def wait_until(self, condition, timeout=None):
+        """Service acks until condition() is True, False on timeout"""
+        if timeout is not None:
+            end = stats.clock() + timeout
+        while not condition():
+            wait = self.timeout
+            if timeout is not None:
+                wait = min(wait, end - stats.clock())
+                if wait <= 0:
+                    return False
+            self.service(wait)
+        return True
+
+    def submit(self, data, ack, nframes=1):
+        """Send encoded data (nframes frames) acked by an ack command"""
+        ack_id = self.messenger.cmds[ack]['id']
+        self._watch(ack_id)
+        self.wait_until(lambda: len(self.inflight) < self.size)
+        r = Request(self, ack_id, data, nframes)
+        with self.condition:
+            self.inflight.append(r)
+            self.pending[ack_id].append(r)
+            self.sent += 1
+            self._write(r)
+        return r
+
+    def send(self, index, ack, *args):
+        """Send index(*args) acked by an ack command, returns a Request"""
+        return self.submit(self.messenger.encoders[index](*args), ack)
+
+    def series(self, values, prepare='kPrepareSendSeries',
+               item='kSendSeries', ack='kAckSendSeries'):
+        """
+        Send a series: prepare(len(values)), an item per value and one
+        ack for the whole series, returns a Request
+        """
+        m = self.messenger
+        data = bytearray(m.encoders[prepare](len(values)))
+        m.encoders[item].encode_many(values, data)
+        return self.submit(data, ack, len(values) + 1)
+
+    def flush(self, timeout=None):
+        """Wait until every request is acked (or failed)"""
+        return self.wait_until(lambda: not self.inflight, timeout)
+
+    def close(self):
+        for handle in self.handles.values():
+            self.messenger.detach(handle)
+        self.handles = {}
+
+    def snapshot(self):
+        return {
+            'size': self.size,
+            'inflight': len(self.inflight),
+            'sent': self.sent,
+            'acked': self.acked,
+            'retransmits': self.retransmits,
+            'failed': self.failed,
+            'unmatched': self.unmatched,
+            'rtt': self.rtt.summary(),
+        }
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+"""
+Lazily decoded frames (see Messenger lazy=True)
+
+A Frame holds the cmd_id and the raw (unescaped) field bytes of a
+received frame. Fields are only converted to python values when they
+are accessed (and the result is cached) so callbacks that only look at
+the cmd_id, or at one field, never pay for converting the rest.
+
+    def callback(frame):
+        if frame[0] > 10:  # only field 0 is decoded
+            ...
+        frame.args()  # all fields
+
+An invalid field raises (ValueError, struct.error...) when accessed
+rather than the frame being dropped by the parser.
+"""
+
+from . import buffer
+
+_missing = object()
+
+
+class Frame(object):
+    __slots__ = ('cmd_id', 'fields', 'decoder', '_args')
+
+    def __init__(self, cmd_id, fields, decoder=None):
+        self.cmd_id = cmd_id
+        self.fields = fields  # list of (raw) bytes
+        self.decoder = decoder  # codec.Decoder, None for unknown commands
+        self._args = None
+
+    def __len__(self):
+        # as for eager decoding, fields past the declared params are ignored
+        n = len(self.fields)
+        if self.decoder is not None and n > self.decoder.nargs:
+            return self.decoder.nargs
+        return n
+
+    def __getitem__(self, i):
+        n = len(self)
+        if i < 0:
+            i += n
+        if i < 0 or i >= n:
+            raise IndexError("field index out of range")
+        if self._args is None:
+            self._args = [_missing] * n
+        v = self._args[i]
+        if v is _missing:
+            if self.decoder is None:
+                v = buffer.to_native(self.fields[i])
+            else:
+                v = self.decoder.converters[i](self.fields[i])
+            self._args[i] = v
+        return v
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def args(self):
+        """All fields decoded (and cached) as a list"""
+        if self._args is None or _missing in self._args:
+            if self.decoder is None:
+                self._args = [buffer.to_native(f) for f in self.fields]
+            else:
+                self._args = self.decoder(self.fields)
+        return list(self._args)
+
+    def __repr__(self):
+        return "Frame(%s, %r)" % (self.cmd_id, self.fields)
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+"""
+Drive many Messengers from one thread with a selector (epoll, kqueue...)
+
+Each Messenger is registered with the file descriptor of its stream
+(stream.fileno(), pyserial ports have one on posix). A poll waits until
+any stream is readable, reads what it has ready (at most max_bytes),
+parses it and dispatches callbacks for every device round robin.
+
+Fairness limits are per device and per poll:
+    max_bytes: bytes read from the stream
+    max_frames: frames dispatched, the rest wait for the next poll
+    max_backlog: decoded frames waiting for dispatch, while a device is
+        over this it is not read (data backs up into the OS buffer)
+so one chatty device cannot starve the others.
+
+    hub = MessengerHub()
+    hub.add(m0, 'board0')
+    hub.add(m1, 'board1')
+    hub.start()  # or call hub.poll(timeout) from your own loop
+    ...
+    hub.stats() -> {'board0': {'bytes_in': ..., ...}, ...}
+    hub.stop()
+"""
+
+import collections
+import selectors
+import threading
+import time
+
+from . import buffer
+
+
+class Device(object):
+    """A Messenger registered with a hub and its per device stats"""
+    def __init__(self, messenger, name, stream):
+        self.messenger = messenger
+        self.name = name
+        self.stream = stream
+        self.frames = collections.deque()  # decoded, waiting for dispatch
+        self.error = None
+        self.clear()
+
+    def clear(self):
+        self.reads = 0
+        self.bytes_in = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.throttled = 0  # polls where reading was skipped (backlog)
+        self.max_backlog = 0
+
+    def snapshot(self):
+        return {
+            'reads': self.reads,
+            'bytes_in': self.bytes_in,
+            'frames_in': self.frames_in,
+            'frames_out': self.frames_out,
+            'backlog': len(self.frames),
+            'max_backlog': self.max_backlog,
+            'throttled': self.throttled,
+            'parse_errors': self.messenger.parser.errors,
+            'callback_errors': self.messenger.callback_errors,
+            'error': None if self.error is None else repr(self.error),
+        }
+
+
+class MessengerHub(object):
+    def __init__(self, max_bytes=4096, max_frames=64, max_backlog=1024,
+                 selector=None):
+        if selector is None:
+            selector = selectors.DefaultSelector()
+        self.selector = selector
+        self.max_bytes = max_bytes
+        self.max_frames = max_frames
+        self.max_backlog = max_backlog
+        self.devices = collections.OrderedDict()  # name: Device
+        self._running = threading.Event()
+        self.thread = None
+
+    def add(self, messenger, name=None, stream=None):
+        """Register messenger (reading stream, by default its stream)"""
+        if stream is None:
+            stream = messenger.stream
+        if name is None:
+            name = len(self.devices)
+        if name in self.devices:
+            raise ValueError("Device %s already registered" % (name, ))
+        device = Device(messenger, name, stream)
+        # bytes already buffered by the messenger are parsed first
+        if len(messenger.rx):
+            self._feed(device, messenger.rx.drain())
+        self.selector.register(stream, selectors.EVENT_READ, device)
+        self.devices[name] = device
+        return device
+
+    def remove(self, name):
+        device = self.devices.pop(name)
+        if device.error is None:
+            self.selector.unregister(device.stream)
+        return device
+
+    def _feed(self, device, data):
+        device.bytes_in += len(data)
+        frames = device.messenger.feed(data)
+        device.frames_in += len(frames)
+        device.frames.extend(frames)
+        if len(device.frames) > device.max_backlog:
+            device.max_backlog = len(device.frames)
+
+    def _read(self, device):
+        if len(device.frames) >= self.max_backlog:
+            device.throttled += 1
+            return
+        stream = device.stream
+        n = min(max(buffer.in_waiting(stream), 1), self.max_bytes)
+        try:
+            data = stream.read(n)
+        except Exception as e:
+            # stream closed or failed, stop reading this device
+            device.error = e
+            self.selector.unregister(stream)
+            return
+        device.reads += 1
+        if data:
+            self._feed(device, buffer.to_bytes(data))
+
+    def _dispatch(self, device):
+        frames = device.frames
+        dispatch = device.messenger.dispatch
+        n = min(len(frames), self.max_frames)
+        for _ in range(n):
+            dispatch(*frames.popleft())
+        device.frames_out += n
+        return n
+
+    def backlog(self):
+        """Number of decoded frames waiting to be dispatched"""
+        return sum(len(d.frames) for d in self.devices.values())
+
+    def poll(self, timeout=None):
+        """
+        Wait up to timeout (None = forever) for any stream to be
+        readable, read and parse what is ready then dispatch (up to
+        max_frames per device) callbacks. Returns frames dispatched.
+        """
+        if self.backlog():
+            timeout = 0
+        if self.selector.get_map():
+            for (key, events) in self.selector.select(timeout):
+                self._read(key.data)
+        elif timeout:
+            time.sleep(timeout)  # nothing to wait on
+        n = 0
+        for device in list(self.devices.values()):
+            if device.frames:
+                n += self._dispatch(device)
+        return n
+
+    def stats(self):
+        """Per device stats: {name: dict}"""
+        return dict(
+            (name, d.snapshot()) for (name, d) in self.devices.items())
+
+    # running
+    def start(self, timeout=0.1):
+        """Poll on a background thread until stop"""
+        if self.thread is not None:
+            raise Exception("Hub already started")
+        self._running.set()
+        self.thread = threading.Thread(target=self.run, args=(timeout, ))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def run(self, timeout=0.1):
+        while self._running.is_set():
+            self.poll(timeout)
+
+    def stop(self, timeout=None):
+        self._running.clear()
+        if self.thread is not None:
+            if self.thread is not threading.current_thread():
+                self.thread.join(timeout)
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        self.selector.close()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+Round trip latency of request/reply command pairs
+
+Pairs are declared on the command table with a 'reply' key:
+    {'name': 'kValuePing', 'params': [...], 'reply': 'kValuePong'}
+and traced automatically by Messenger (or with Messenger.trace_latency).
+
+Like stats, tracing is installed by wrapping the write and feed methods
+of the Messenger instance. A written frame starting with the encoded
+prefix of a request is timestamped (with a monotonic clock), a received
+reply is matched to the oldest outstanding request that it answers and
+the round trip time is added to a (fixed size) histogram of the pair.
+Batches (call_many, send_batch) are not traced.
+
+At most max_outstanding send times are kept per pair, older ones are
+dropped (and counted as lost) so memory is bounded even if replies never
+arrive.
+
+    m.latency() -> {'kValuePing->kValuePong': {
+        'n': ..., 'mean': ..., 'p50': ..., 'p99': ..., 'max': ...,
+        'outstanding': ..., 'lost': ...}, ...}
+"""
+
+import collections
+
+from . import stats
+
+
+class Pair(object):
+    def __init__(self, request, reply, max_outstanding=1024):
+        self.request = request  # resolved command dicts
+        self.reply = reply
+        self.name = "%s->%s" % (
+            request.get('name', request['id']),
+            reply.get('name', reply['id']))
+        self.sent = collections.deque()
+        self.max_outstanding = max_outstanding
+        self.histogram = stats.Histogram()
+        self.lost = 0
+
+    def summary(self):
+        s = self.histogram.summary()
+        s['outstanding'] = len(self.sent)
+        s['lost'] = self.lost
+        return s
+
+
+def declared_pairs(cmds):
+    """(request, reply) index pairs declared with 'reply' in cmds"""
+    pairs = []
+    for (i, c) in enumerate(cmds):
+        if isinstance(c, dict) and 'reply' in c:
+            pairs.append((c.get('name', i), c['reply']))
+    return pairs
+
+
+class LatencyTracer(stats.Instrument):
+    methods = ('feed', 'write')
+
+    def __init__(self, messenger, pairs, max_outstanding=1024):
+        """pairs is a list of (request, reply) (cmd_ids or names)"""
+        stats.Instrument.__init__(self, messenger)
+        self.pairs = []
+        self.heads = []  # (encoded request prefixes, pair)
+        self.replies = {}  # reply cmd_id: [pairs]
+        self.unmatched = 0
+        for (request, reply) in pairs:
+            p = Pair(
+                messenger.cmds[request], messenger.cmds[reply],
+                max_outstanding)
+            self.pairs.append(p)
+            e = messenger.encoders[p.request['id']]
+            self.heads.append(
+                ((e.head, e.empty) if e.nargs else (e.empty, ), p))
+            self.replies.setdefault(p.reply['id'], []).append(p)
+
+    def sent(self, data, t):
+        for (head, p) in self.heads:
+            if data.startswith(head):
+                if len(p.sent) >= p.max_outstanding:
+                    p.sent.popleft()
+                    p.lost += 1
+                p.sent.append(t)
+                return
+
+    def received(self, cmd_id, t):
+        pairs = self.replies[cmd_id]
+        if len(pairs) == 1:
+            p = pairs[0]
+            if not p.sent:
+                self.unmatched += 1
+                return
+        else:
+            # the reply answers the oldest request of any of its pairs
+            waiting = [p for p in pairs if p.sent]
+            if not waiting:
+                self.unmatched += 1
+                return
+            p = min(waiting, key=lambda p: p.sent[0])
+        p.histogram.add(t - p.sent.popleft())
+
+    def wrap_feed(self, feed):
+        replies = self.replies
+        received = self.received
+        clock = stats.clock
+
+        def traced_feed(data):
+            frames = feed(data)
+            t = clock()
+            for frame in frames:
+                if frame[0] in replies:
+                    received(frame[0], t)
+            return frames
+        return traced_feed
+
+    def wrap_write(self, write):
+        sent = self.sent
+        clock = stats.clock
+
+        def traced_write(data, nframes=1):
+            if nframes == 1:
+                sent(data, clock())
+            write(data, nframes)
+        return traced_write
+
+    def clear(self):
+        for p in self.pairs:
+            p.sent.clear()
+            p.histogram.clear()
+            p.lost = 0
+        self.unmatched = 0
+
+    def snapshot(self):
+        return dict((p.name, p.summary()) for p in self.pairs)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+"""
+Bounded log of received messages (used by tests.Expect)
+
+Messages are kept in a fixed size ring so memory does not grow with the
+number of messages received. When the log is full the eviction policy
+decides what is kept:
+    'oldest': the oldest message is overwritten (keeps the latest)
+    'newest': new messages are dropped (keeps the first capacity)
+
+The last message for every cmd_id is tracked separately (and is never
+evicted) so log.last(cmd_id) is O(1) no matter how long the log runs.
+
+    log = MessageLog(capacity=1000)
+    log.append(cmd_id, args)
+    log.last() -> the last message
+    log.last(cmd_id).args
+"""
+
+import collections
+
+from . import stats
+
+
+class Message(object):
+    __slots__ = ('id', 'args', 'time', 'seq')
+
+    def __init__(self, cmd_id, args, time, seq):
+        self.id = cmd_id
+        self.args = args
+        self.time = time
+        self.seq = seq  # number of messages logged before this one
+
+    def __getitem__(self, key):
+        # message['id'], message['args'] as for the old dict messages
+        return getattr(self, key)
+
+    def __repr__(self):
+        return "Message(%s, %r)" % (self.id, self.args)
+
+
+class MessageLog(object):
+    def __init__(self, capacity=10000, policy='oldest'):
+        if policy not in ('oldest', 'newest'):
+            raise ValueError("Unknown eviction policy %s" % policy)
+        if capacity < 1:
+            raise ValueError("capacity must be >= 1")
+        self.capacity = capacity
+        self.policy = policy
+        self.clear()
+
+    def clear(self):
+        self.ring = [None] * self.capacity
+        self.start = 0  # index of the oldest message in ring
+        self.n = 0  # messages in ring
+        self.seq = 0  # messages logged
+        self.evicted = 0
+        self.dropped = 0
+        self.counts = collections.Counter()  # cmd_id: messages logged
+        self.last_by_id = {}  # cmd_id: last Message
+        self.last_message = None
+
+    def append(self, cmd_id, args):
+        """Log a message, returns the Message"""
+        msg = Message(cmd_id, args, stats.clock(), self.seq)
+        self.seq += 1
+        self.counts[cmd_id] += 1
+        self.last_by_id[cmd_id] = msg
+        self.last_message = msg
+        if self.n < self.capacity:
+            self.ring[(self.start + self.n) % self.capacity] = msg
+            self.n += 1
+        elif self.policy == 'oldest':
+            self.ring[self.start] = msg
+            self.start = (self.start + 1) % self.capacity
+            self.evicted += 1
+        else:
+            self.dropped += 1
+        return msg
+
+    def last(self, cmd_id=None):
+        """Last message (for cmd_id if not None), None if there is none"""
+        if cmd_id is None:
+            return self.last_message
+        return self.last_by_id.get(cmd_id, None)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        # 0 is the oldest message in the log, -1 the newest
+        if i < 0:
+            i += self.n
+        if i < 0 or i >= self.n:
+            raise IndexError("message index out of range")
+        return self.ring[(self.start + i) % self.capacity]
+
+    def __iter__(self):
+        for i in range(self.n):
+            yield self.ring[(self.start + i) % self.capacity]
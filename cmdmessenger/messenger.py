@@ -9,13 +9,27 @@ use stream.inWaiting to check if bytes are available
         name: [string] namespace name, only used for commands
         id: [int] message id, only used for commands
         params: [list of types, see params.py] if not present, no params
+        reply: [string] name of the reply command, request/reply round
+            trip times are traced (see latency.py)
         function: [callable] only used for callbacks
 
 """
 
+import collections
+import select
+import struct
+import time
+import traceback
 import warnings
 
+from . import buffer
+from . import codec
+from . import commands
+from . import escaping
+from . import frame
 from . import params
+from . import parser
+from . import registry
 
 
 class InvalidCommand(Exception):
@@ -61,40 +75,19 @@ def split_line(l, fs=',', ls=';', esc='/'):
             i += sub_sub_line.index(fs) + 1
         tokens.append(sub_line[:i])
         start += i + 1
-        if len(tokens) > 5:
-            raise Exception
     return tokens
 
 
 def escape(s, fs=',', ls=';', esc='/'):
     if isinstance(s, (tuple, list)):
         return [escape(i, fs, ls, esc) for i in s]
-    # TODO optimize this
-    cs = [fs, ls, esc, '\x00']
-    ns = ""
-    for c in s:
-        if c in cs:
-            ns += esc
-        ns += c
-    return ns
+    return escaping.escape(s, fs, ls, esc)
 
 
 def unescape(s, esc='/'):
     if isinstance(s, (tuple, list)):
         return [unescape(i, esc) for i in s]
-    # TODO optimize this
-    ns = ""
-    i = 0
-    while i < len(s):
-        if s[i] == esc:
-            i += 1
-            if i < len(s):
-                ns += s[i]
-        else:
-            ns += s[i]
-        i += 1
-    return ns
-    #return s.replace(esc, '')
+    return escaping.unescape(s, esc)
 
 
 def check_pt(pt):
@@ -115,16 +108,77 @@ def check_pt(pt):
 
 
 class Messenger(object):
-    def __init__(self, stream, cmds, fs=',', ls=';', esc='/'):
-        """cmds should be a list"""
+    def __init__(
+            self, stream, cmds, fs=',', ls=';', esc='/', chunk_size=4096,
+            max_write=None, lazy=False, table=None):
+        """
+        cmds should be a list
+
+        table is a compiled command table (see compiler.py and
+        from_spec) providing the resolved cmds, codecs and command
+        factories (cmds, fs, ls and esc must be those of the table)
+
+        max_write limits the number of bytes per stream.write call
+        (None writes everything at once)
+
+        if lazy is True callbacks receive a single frame.Frame (fields
+        are decoded when accessed) rather than the decoded args
+        """
         self.stream = stream
         self.fs = fs
         self.ls = ls
         self.esc = esc
+        # separators as they appear on the wire
+        self._fs = buffer.to_bytes(fs)
+        self._ls = buffer.to_bytes(ls)
+        self._esc = buffer.to_bytes(esc)
+        self.rx = buffer.ReceiveBuffer(stream, chunk_size)
+        self.max_write = max_write
+        self.lazy = lazy
+        self.collectors = {}
+        self.read_thread = None
+        self._capture = None
+        self._stats = None
+        # installed instrumentation and the methods it wrapped (stats.py)
+        self._instruments = []
+        self._unwrapped = {}
+        if table is not None:
+            # resolved (and validated) commands and codecs are shared by
+            # every Messenger using the table
+            self.cmds = dict(table.cmds)
+            self.decoders = dict(table.decoders)
+            self.encoders = dict(table.encoders)
+            self.parser = parser.Parser(None, self._fs, self._ls, self._esc)
+            self.parser.layouts = table.layouts
+        else:
+            self._resolve(cmds)
+            self.parser = parser.Parser(
+                dict((i, self.cmds[i].get('params', []))
+                     for i in range(len(cmds))),
+                self._fs, self._ls, self._esc)
+        # prebound command stubs: self.cmd.name(*args)
+        self.cmd = commands.Namespace(
+            self, self.encoders,
+            None if table is None else table.command_factories)
+        self.registry = registry.Registry(range(len(cmds)))
+        # cmd_id: tuple of callables, maintained by the registry (callbacks
+        # for all commands are in self.registry.wildcards)
+        self.callbacks = self.registry.dispatch
+        self.callback_errors = 0  # callbacks that raised (see dispatch)
+        self._frames = collections.deque()
+        self._line_parser = None  # for process_line
+        # request/reply pairs declared with 'reply' are traced
+        self._latency = None
+        if any(isinstance(c, dict) and 'reply' in c for c in cmds):
+            self.trace_latency()
+
+    def _resolve(self, cmds):
+        # resolve and validate cmds, set up (shared) codecs
         # TODO validate commands
         validate_command(cmds)
         self.cmds = {}
-        self.callbacks = {}
+        self.decoders = {}
+        self.encoders = {}
         for (i, c) in enumerate(cmds):
             # resolve command name
             if not isinstance(c, dict):
@@ -141,115 +195,405 @@ class Messenger(object):
                     check_pt(pt)
                     ps.append(pt)
                 c['params'] = ps
-            self.callbacks[i] = []
+            self.decoders[i] = codec.get_decoder(c.get('params', []))
+            self.encoders[i] = codec.get_encoder(
+                i, c.get('params', []), self._fs, self._ls, self._esc)
             self.cmds[i] = c
             if 'name' in c:
                 self.cmds[c['name']] = c
+                self.encoders[c['name']] = self.encoders[i]
+
+    @classmethod
+    def from_spec(cls, stream, spec, cache_dir=None, **kwargs):
+        """
+        Messenger for a declarative command table spec (a dict, list or
+        json filename) compiled once and cached on disk, see compiler.py
+        """
+        from . import compiler
+        table = compiler.compile_table(spec, cache_dir)
+        return cls(
+            stream, table.commands, table.fs, table.ls, table.esc,
+            table=table, **kwargs)
 
     # stream parsing
+    def on_error(self, cmd_id, args):
+        # called (in the except block) when a callback raises
+        self.callback_errors += 1
+        traceback.print_exc()
+
+    def dispatch(self, cmd_id, args):
+        """
+        trigger the callbacks for a frame, a callback that raises is
+        passed to on_error (so one bad callback does not stop a reader)
+        """
+        try:
+            self.trigger(cmd_id, *args)
+        except Exception:
+            self.on_error(cmd_id, args)
+
     def trigger(self, cmd_id, *args):
-        if len(self.callbacks.get(cmd_id, [])) == 0:
+        callbacks = self.callbacks.get(cmd_id, None)
+        wildcards = self.registry.wildcards
+        if callbacks is None or not (callbacks or wildcards):
             self.unknown()
-        else:
-            [c(*args) for c in self.callbacks[cmd_id]]
+            return
+        for c in callbacks:
+            c(*args)
+        for c in wildcards:
+            c(cmd_id, *args)
 
     def next_value(self, until=None, escape=False, n=None):
+        """
+        Read the next value: up to until (the field separator by default)
+        or, for fixed width values, n bytes.
+        """
         if until is None:
             until = self.fs
-        print("\t\t%s:%s" % (until, escape))
-        s = ""
-        while True:
-            c = self.stream.read(1)
-            if escape and c == self.esc:
-                c = self.stream.read(1)
-            s += c
-            if c in until and n is None:
-                break
-            if n is not None and len(s) == n:
-                break
-        print("\tnext_value: %s" % s)
+        esc = self._esc if escape else None
+        if n is None:
+            s = self.rx.read_until(buffer.to_bytes(until), esc, escape)
+        else:
+            s = self.rx.read(n, esc)
         return s
 
-        if until is None:
-            until = self.fs
-        c = self.stream.read(1)
-        while c[-1] not in until:
-            c += self.stream.read(1)
-            if escape and c[-1] == self.esc:
-                c = self.stream.read(1)
-        print("\tnext_value: %s" % c)
-        return c
+    def decode(self, cmd_id, fields):
+        """Convert the (bytes) fields of a frame to python values"""
+        decoder = self.decoders.get(cmd_id, None)
+        if decoder is None:
+            return [buffer.to_native(f) for f in fields]
+        return decoder(fields)
 
-    def next_command(self):
-        s = self.next_value(self.fs + self.ls)
-        cmd_id = int(s[:-1])
-        if s[-1] == self.ls:
-            self.trigger(cmd_id)
-        cmd = self.cmds[cmd_id]
-        ptypes = cmd['params']
-        args = []
-        print("\tfound %s[%s]: %s" % (cmd_id, cmd.get('name', '?'), ptypes))
-        while len(args) < len(ptypes):
-            ptype = ptypes[len(args)]
-            print("\t\t\t%s" % ptype)
-            n = ptype.get('n', None)
-            esc = ptype.get('escape', False)
-            if n is None:
-                s = self.next_value(self.fs + self.ls, esc)
+    def feed(self, data):
+        """
+        Parse a chunk of bytes (from any source), returning a list of
+        decoded (cmd_id, args) for every frame completed by this chunk.
+        Partial frames are kept until the rest of the frame is fed.
+        Frames consumed by a series collector are not returned and frames
+        that fail to decode are dropped (and counted as parser errors).
+        If lazy, args is a 1 tuple of a frame.Frame (decoded on access).
+        """
+        data = buffer.to_bytes(data)
+        if self.collectors:
+            return self._decode_frames(self._feed_collecting(data))
+        return self._decode_frames(self.parser.feed(data))
+
+    def _decode_frames(self, frames):
+        # decode (cmd_id, fields) frames, dropping invalid frames
+        if self.lazy:
+            decoders = self.decoders
+            return [
+                (cmd_id, (frame.Frame(cmd_id, fields, decoders.get(cmd_id)), ))
+                for (cmd_id, fields) in frames]
+        decoded = []
+        for (cmd_id, fields) in frames:
+            try:
+                decoded.append((cmd_id, self.decode(cmd_id, fields)))
+            except (ValueError, IndexError, struct.error):
+                # invalid field, drop this frame
+                self.parser.errors += 1
+        return decoded
+
+    def _feed_collecting(self, data):
+        # while the parser is between frames, runs of frames of a collected
+        # command skip the parser, return the remaining (not collected)
+        # frames
+        parser = self.parser
+        collectors = self.collectors
+        remaining = []
+        i = 0
+        n = len(data)
+        while i < n and collectors:
+            match = None
+            for c in collectors.values():
+                m = c.run.search(data, i)
+                if m is not None and (
+                        match is None or m.start() < match[0].start()):
+                    match = (m, c)
+            if match is None:
+                break
+            m, c = match
+            remaining.extend(self._collect(parser.feed(data[i:m.start()])))
+            if collectors.get(c.cmd_id, None) is c and not parser.partial():
+                c.extend(data[m.start():m.end()])
             else:
-                s = self.next_value('', esc, n + 1)
-            args.append(ptype['from'](s[:-1]))
-        print(args, s)
-        if s[-1] != self.ls:
-            print('\tflushing until ls')
-            self.next_value(self.ls)
+                remaining.extend(
+                    self._collect(parser.feed(data[m.start():m.end()])))
+            i = m.end()
+        remaining.extend(self._collect(parser.feed(data[i:])))
+        for c in collectors.values():
+            self.parser.errors += c.flush()
+        return remaining
+
+    def _collect(self, frames):
+        # hand frames to series collectors, return the remaining frames
+        if not self.collectors:
+            return frames
+        remaining = []
+        for frame in frames:
+            c = self.collectors.get(frame[0], None)
+            if c is not None:
+                c.append(frame[1])
+                continue
+            for c in list(self.collectors.values()):
+                if c.done_id == frame[0]:
+                    self.parser.errors += c.flush()
+                    del self.collectors[c.cmd_id]
+                    c.finish()
+            remaining.append(frame)
+        return remaining
+
+    def next_command(self):
+        while not self._frames:
+            if not len(self.rx):
+                self.rx.fill()
+            self._frames.extend(self.feed(self.rx.drain()))
+        cmd_id, args = self._frames.popleft()
         self.trigger(cmd_id, *args)
 
+    def readable(self, timeout=0.):
+        """
+        True if the stream has bytes ready, waiting up to timeout (None
+        waits forever) using the stream file descriptor if it has one,
+        otherwise by checking in_waiting every millisecond
+        """
+        if buffer.in_waiting(self.stream):
+            return True
+        try:
+            fd = self.stream.fileno()
+        except Exception:  # no (usable) file descriptor
+            fd = None
+        if fd is not None:
+            return bool(select.select([fd], [], [], timeout)[0])
+        if timeout is not None and timeout <= 0:
+            return False
+        end = None if timeout is None else time.time() + timeout
+        while end is None or time.time() < end:
+            time.sleep(0.001)
+            if buffer.in_waiting(self.stream):
+                return True
+        return False
+
+    def process_available(self, max_frames=None):
+        """
+        Without blocking, read what the stream has ready and dispatch
+        (up to max_frames) complete frames. Partial frames are kept for
+        later calls. Returns the number of frames dispatched.
+        """
+        if self.readable(0):
+            try:
+                self.rx.fill()
+            except buffer.ReadTimeout:
+                pass
+        if len(self.rx):
+            self._frames.extend(self.feed(self.rx.drain()))
+        frames = self._frames
+        n = len(frames)
+        if max_frames is not None and max_frames < n:
+            n = max_frames
+        trigger = self.trigger
+        for _ in range(n):
+            cmd_id, args = frames.popleft()
+            trigger(cmd_id, *args)
+        return n
+
+    def poll(self, timeout=0.):
+        """
+        Wait up to timeout (None waits forever) for data if no complete
+        frames are buffered then process_available, returns the number
+        of frames dispatched
+        """
+        if not self._frames and not len(self.rx):
+            self.readable(timeout)
+        return self.process_available()
+
     def process_line(self, l):
-        print("\tprocess[%s]: %s" % (len(l), l.strip()))
-        #tokens = unescape(
-        #    split_line(l, self.fs, self.ls, self.esc),
-        #    self.esc)
-        tokens = split_line(l, self.fs, self.ls, self.esc)
-        cmd_id = int(tokens[0])
-        types = self.cmds[cmd_id].get('params', [])
-        args = [t['from'](a) for (t, a) in zip(types, tokens[1:])]
-        if len(self.callbacks.get(cmd_id, [])) == 0:
-            self.unknown(*args)
-        else:
-            [c(*args) for c in self.callbacks[cmd_id]]
+        """
+        Parse and dispatch one line (a frame, the trailing ls is optional)
+        on its own, independent of any partial frame read from the stream
+        """
+        if self._line_parser is None:
+            self._line_parser = self.parser.clone()
+        p = self._line_parser
+        p.reset()
+        frames = p.feed(buffer.to_bytes(l).strip())
+        if p.partial():
+            frames.extend(p.feed(self._ls))
+        self.parser.errors += p.errors
+        p.errors = 0
+        for (cmd_id, args) in self._decode_frames(frames):
+            if not self.registry.handled(cmd_id):
+                self.unknown(*args)
+                continue
+            self.trigger(cmd_id, *args)
 
     def read_line(self):
-        l = self.stream.read(1)  # TODO optimize this
-        esc = l[-1] == self.esc
-        while l[-1] != self.ls or esc:
-            l += self.stream.read(1)
-            if esc:
-                esc = False
-            else:
-                esc = l[-1] == self.esc
-        return l
+        return self.rx.read_until(self._ls, self._esc)
+
+    def write(self, data, nframes=1):
+        """
+        Write bytes (containing nframes frames) to the stream in as few
+        writes as max_write allows
+        """
+        if self.max_write is None or len(data) <= self.max_write:
+            self.stream.write(data)
+            return
+        view = memoryview(data)
+        for i in range(0, len(data), self.max_write):
+            self.stream.write(view[i:i + self.max_write])
 
     def send(self, cmd_id, *args):
-        #msg = self.fs.join(
-        #    (str(cmd_id), ) +
-        #    tuple(escape(args, self.fs, self.ls, self.esc))) + self.ls
-        msg = self.fs.join((str(cmd_id), ) + args) + self.ls
-        print("\tsend[%s]: %s" % (len(msg), msg.strip()))
-        self.stream.write(msg)
+        # args must already be converted (and escaped if needed)
+        msg = self._fs.join(
+            (buffer.to_bytes(str(cmd_id)), ) +
+            tuple(buffer.to_bytes(a) for a in args)) + self._ls
+        self.write(msg)
         # TODO LFCF?
 
+    def send_batch(self, frames):
+        """
+        Encode many (index, args) frames into one buffer and write it,
+        index can be a cmd_id or name, args is a tuple of (unconverted)
+        args
+        """
+        out = bytearray()
+        n = 0
+        for (index, args) in frames:
+            self.encoders[index].encode_into(out, args)
+            n += 1
+        self.write(out, n)
+
     # callbacks
-    def attach(self, func, index):
-        self.callbacks[index].append(func)
-        return id(func)
+    def attach(self, func, index=None):
+        """
+        Attach func to be called when an index (cmd_id or name) command is
+        received, or for every command (as func(cmd_id, *args)) if index
+        is None. Returns a handle for detach
+        """
+        if index is not None:
+            index = self.cmds[index]['id']
+        return self.registry.attach(func, index)
+
+    def detach(self, handle):
+        self.registry.detach(handle)
+
+    def collect(self, index, done=None, length=None):
+        """
+        Collect all index commands into a numpy array (see series.py)
+        until a done command is received. If length is known (for example
+        the length sent with kRequestSeries) the array is preallocated.
+        Returns a SeriesCollector, see SeriesCollector.data and .done
+        """
+        from . import series
+        cmd = self.cmds[index]
+        done_id = None if done is None else self.cmds[done]['id']
+        c = series.SeriesCollector(
+            cmd, done_id, length, self._fs, self._ls, self._esc)
+        self.collectors[cmd['id']] = c
+        return c
+
+    def sink(self, directory, index=None, **kwargs):
+        """
+        Store received commands (all or only index) in memory mapped
+        typed columns in directory (see sink.py), returns a ColumnSink
+        """
+        from . import sink
+        return sink.ColumnSink(directory, self.cmds, **kwargs).attach(
+            self, index)
+
+    # instrumentation
+    def enable_stats(self, **hooks):
+        """
+        Start counting bytes, frames, errors and timing parsing and
+        dispatch (see stats.py for the optional hooks). When stats are
+        not enabled no instrumentation code runs.
+        """
+        from . import stats
+        self.disable_stats()
+        self._stats = stats.Stats(self, **hooks)
+        self._stats.install()
+        return self._stats
 
-    def detach(self, callback_id):
-        if not isinstance(callback_id, int):
-            callback_id = id(callback_id)
-        for cmd_id in self.callbacks:
-            if callback_id in self.callbacks[cmd_id]:
-                self.callbacks[cmd_id].remove(callback_id)
+    def disable_stats(self):
+        if self._stats is not None:
+            self._stats.uninstall()
+            self._stats = None
+
+    def stats(self):
+        """Snapshot (dict) of the stats, None if stats are not enabled"""
+        if self._stats is None:
+            return None
+        return self._stats.snapshot()
+
+    # latency
+    def trace_latency(self, pairs=None, max_outstanding=1024):
+        """
+        Trace the round trip time of (request, reply) pairs (default: the
+        pairs declared with 'reply' on the command table), see latency.py
+        """
+        from . import latency
+        if pairs is None:
+            pairs = latency.declared_pairs(
+                [self.cmds[i] for i in range(len(self.decoders))])
+        self.stop_latency()
+        self._latency = latency.LatencyTracer(self, pairs, max_outstanding)
+        self._latency.install()
+        return self._latency
+
+    def stop_latency(self):
+        if self._latency is not None:
+            self._latency.uninstall()
+            self._latency = None
+
+    def latency(self):
+        """Latency summary per traced pair, None if nothing is traced"""
+        if self._latency is None:
+            return None
+        return self._latency.snapshot()
+
+    # capture
+    def start_capture(self, f):
+        """
+        Record every chunk read and written (with timestamps) to f, a
+        filename or binary file (see capture.py)
+        """
+        from . import capture
+        self.stop_capture()
+        self._capture = capture.Capture(f, self)
+        self._capture.install()
+        return self._capture
+
+    def stop_capture(self):
+        if self._capture is not None:
+            self._capture.close()
+            self._capture = None
+
+    # threaded reading
+    def start_reader(self, mode='inline', workers=4, queue_size=1024):
+        """
+        Start a background thread that reads and parses frames, callbacks
+        are run by a dispatcher in one of the modes (see threaded.py):
+            'inline', 'single' or 'pool' (of workers threads)
+        """
+        from . import threaded
+        if self.read_thread is not None:
+            raise Exception("Reader already started")
+        dispatcher = threaded.Dispatcher(
+            self.dispatch, mode, workers, queue_size)
+        self.read_thread = threaded.ThreadedReader(self, dispatcher).start()
+        return self.read_thread
+
+    def stop_reader(self, timeout=None):
+        if self.read_thread is not None:
+            self.read_thread.stop(timeout)
+            self.read_thread = None
+
+    def window(self, size=8, timeout=1., retries=3, pump=None):
+        """
+        Flow control for acknowledged commands, keeps up to size commands
+        waiting for an ack in flight (see flow.py)
+        """
+        from . import flow
+        return flow.Window(self, size, timeout, retries, pump)
 
     def unknown(self, *args):
         pass  # called when an unknown command is received
@@ -257,6 +601,14 @@ class Messenger(object):
     # commands
     def call(self, index, *args):
         # can be cmd_id or name
-        cmd = self.cmds[index]
-        types = cmd.get('params', [])
-        self.send(cmd['id'], *[t['to'](a) for (t, a) in zip(types, args)])
+        self.write(self.encoders[index](*args))
+
+    def call_many(self, index, values):
+        """
+        Send index once for each item in values (a tuple of args) with
+        a single write (or as few as max_write allows). For commands with
+        a single param, values can be a sequence of values or numpy array.
+        """
+        if not hasattr(values, '__len__'):
+            values = list(values)
+        self.write(self.encoders[index].encode_many(values), len(values))
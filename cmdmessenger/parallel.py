@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+"""
+Parallel (process pool) decoding of recorded traffic
+
+The received bytes (of a capture file, see capture.py, or a raw dump of
+the stream) are split at unescaped ls (frame) boundaries into chunks
+that are decoded independently in a pool of processes, each with its
+own Messenger built from the same command table. Results are merged
+back in order per command.
+
+Files are never loaded by the parent: workers are sent (path, start,
+stop) offsets into the received bytes and read their own range from a
+memory map of the file. A chunk starts after the first unescaped ls at
+or after start and ends with the first unescaped ls at or after stop, so
+neighbouring chunks agree on their boundary without scanning the data
+up front.
+
+    frames, errors = parallel.decode('run.cap', tests.cmds)
+    frames[cmd_id] -> list of args (in the order received)
+
+    python -m cmdmessenger.parallel run.cap [-j 8] [-o frames.json]
+"""
+
+import bisect
+import collections
+import json
+import mmap
+import os
+import sys
+import warnings
+
+from . import buffer
+from . import capture
+from . import messenger
+from . import stats
+
+
+def load(f):
+    """Received bytes of a capture file (or all bytes of a raw dump)"""
+    with open(f, 'rb') as fp:
+        is_capture = fp.read(len(capture.magic)) == capture.magic
+        fp.seek(0)
+        if not is_capture:
+            return fp.read()
+        return b''.join(
+            data for (t, direction, data) in capture.read(fp)
+            if direction == capture.RX)
+
+
+def is_escaped(data, i, esc):
+    """True if data[i] follows an (unescaped) esc"""
+    n = 0
+    while i - n > 0 and data[i - n - 1] == esc:
+        n += 1
+    return n % 2 == 1
+
+
+def split(data, ls=';', esc='/', chunk_size=1 << 20):
+    """
+    Split data into (start, stop) chunks of about chunk_size bytes that
+    end on an unescaped ls (the last chunk ends with the data)
+    """
+    ls = ord(buffer.to_bytes(ls))
+    esc = ord(buffer.to_bytes(esc))
+    chunks = []
+    start = 0
+    n = len(data)
+    while start < n:
+        i = start + chunk_size
+        while i < n and (data[i] != ls or is_escaped(data, i, esc)):
+            i = data.find(bytes((ls, )), i + 1)
+            if i == -1:
+                i = n
+        stop = min(i + 1, n)
+        chunks.append((start, stop))
+        start = stop
+    return chunks
+
+
+class Source(object):
+    """
+    The received bytes of a capture file (or all bytes of a raw dump)
+    read by offset from a memory map, without loading the file
+    """
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.data = b''
+            if size:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # received bytes are runs of the file: (start, file offset, length)
+        self.starts = []
+        self.offsets = []
+        self.lengths = []
+        self.size = 0
+        if self.data[:len(capture.magic)] == capture.magic:
+            i = len(capture.magic) + capture.header.size
+            while i + capture.record.size <= size:
+                t, direction, n = capture.record.unpack_from(self.data, i)
+                i += capture.record.size
+                n = min(n, size - i)  # a truncated last record
+                if direction == capture.RX and n:
+                    self._add(i, n)
+                i += n
+        elif size:
+            self._add(0, size)
+
+    def _add(self, offset, n):
+        self.starts.append(self.size)
+        self.offsets.append(offset)
+        self.lengths.append(n)
+        self.size += n
+
+    def read(self, start, stop):
+        """Received bytes [start:stop]"""
+        start = max(start, 0)
+        stop = min(stop, self.size)
+        parts = []
+        k = bisect.bisect_right(self.starts, start) - 1
+        while start < stop:
+            s, o = self.starts[k], self.offsets[k]
+            end = min(stop, s + self.lengths[k])
+            parts.append(self.data[o + start - s:o + end - s])
+            start = end
+            k += 1
+        return b''.join(parts)
+
+    def escaped(self, i, esc):
+        """True if byte i follows an (unescaped) esc"""
+        n = 0
+        while i - n > 0:
+            data = self.read(max(0, i - n - 64), i - n)
+            run = len(data) - len(data.rstrip(esc))
+            n += run
+            if run < len(data):
+                break
+        return n % 2 == 1
+
+    def boundary(self, i, ls=';', esc='/'):
+        """Offset after the first unescaped ls at or after i (0 for 0)"""
+        if i <= 0:
+            return 0
+        ls = buffer.to_bytes(ls)
+        esc = buffer.to_bytes(esc)
+        window = 64  # frames are usually short, grow for long ones
+        while i < self.size:
+            data = self.read(i, i + window)
+            j = data.find(ls)
+            while j != -1:
+                if not self.escaped(i + j, esc):
+                    return i + j + 1
+                j = data.find(ls, j + 1)
+            i += len(data)
+            window = min(window * 2, 1 << 16)
+        return self.size
+
+
+_sources = {}
+
+
+def _source(path):
+    # one Source per process and (unchanged) file
+    st = os.stat(path)
+    key = (os.path.abspath(path), st.st_mtime, st.st_size)
+    if key not in _sources:
+        _sources[key] = Source(path)
+    return _sources[key]
+
+
+_messengers = {}
+
+
+def _messenger(cmds, fs, ls, esc):
+    # one (streamless) Messenger per process and command table
+    key = repr((cmds, fs, ls, esc))
+    if key not in _messengers:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            _messengers[key] = messenger.Messenger(None, cmds, fs, ls, esc)
+    return _messengers[key]
+
+
+def decode_chunk(data, cmds, fs=',', ls=';', esc='/'):
+    """Decode one chunk, returns ({cmd_id: [args, ...]}, errors)"""
+    m = _messenger(cmds, fs, ls, esc)
+    m.parser.reset()
+    errors = m.parser.errors
+    frames = collections.defaultdict(list)
+    for (cmd_id, args) in m.feed(data):
+        frames[cmd_id].append(args)
+    # a chunk that ends mid frame (only the last) is dropped
+    m.parser.reset()
+    return dict(frames), m.parser.errors - errors
+
+
+def decode_range(path, start, stop, cmds, fs=',', ls=';', esc='/'):
+    """
+    Decode the frames of path (a capture or raw dump) that end in the
+    received bytes [start:stop], see Source.boundary
+    """
+    source = _source(path)
+    data = source.read(
+        source.boundary(start, ls, esc), source.boundary(stop, ls, esc))
+    return decode_chunk(data, cmds, fs, ls, esc)
+
+
+def decode(f, cmds, fs=',', ls=';', esc='/', processes=None,
+           chunk_size=1 << 20):
+    """
+    Decode the received bytes of f (a capture or raw dump filename, or
+    bytes) in a pool of processes (None = one per cpu, 0 = no pool).
+    cmds must be picklable (param types by name, as for Messenger).
+    Returns ({cmd_id: [args, ...]}, number of invalid frames)
+    """
+    if isinstance(f, (bytes, bytearray)):
+        view = memoryview(f)
+        tasks = [
+            (bytes(view[a:b]), cmds, fs, ls, esc)
+            for (a, b) in split(f, ls, esc, chunk_size)]
+        work = _decode_chunk
+    else:
+        size = _source(f).size
+        tasks = [
+            (f, a, a + chunk_size, cmds, fs, ls, esc)
+            for a in range(0, size, chunk_size)]
+        work = _decode_range
+    if processes == 0 or len(tasks) < 2:
+        results = [work(t) for t in tasks]
+    else:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(processes) as pool:
+            # a few batches of tasks per worker
+            workers = processes or os.cpu_count() or 1
+            chunksize = max(1, len(tasks) // (4 * workers))
+            results = list(pool.map(work, tasks, chunksize=chunksize))
+    frames = {}
+    errors = 0
+    for (r, e) in results:
+        errors += e
+        for (cmd_id, args) in r.items():
+            frames.setdefault(cmd_id, []).extend(args)
+    return frames, errors
+
+
+def _decode_chunk(c):
+    return decode_chunk(*c)
+
+
+def _decode_range(c):
+    return decode_range(*c)
+
+
+def cmds_from_path(path):
+    """Command table from 'module:attribute' (for the command line)"""
+    import importlib
+    module, attr = path.split(':')
+    return getattr(importlib.import_module(module), attr)
+
+
+def run(filename, cmds='cmdmessenger.tests:cmds', processes=None,
+        chunk_size=1 << 20, output=None):
+    cmd_table = cmds_from_path(cmds)
+    t0 = stats.clock()
+    frames, errors = decode(
+        filename, cmd_table, processes=processes, chunk_size=chunk_size)
+    t = stats.clock() - t0
+    n = sum(len(v) for v in frames.values())
+    print("%s: %i frames (%i errors) in %.3f s [%.0f frames/s]" % (
+        filename, n, errors, t, n / t if t else 0))
+    for cmd_id in sorted(frames):
+        c = cmd_table[cmd_id]
+        name = c.get('name', cmd_id) if isinstance(c, dict) else c
+        print("%-24s %10i" % (name, len(frames[cmd_id])))
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(dict((str(k), v) for (k, v) in frames.items()), f)
+    return frames, errors
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('filename')
+    parser.add_argument(
+        '-c', '--cmds', default='cmdmessenger.tests:cmds',
+        help="command table as module:attribute")
+    parser.add_argument('-j', '--processes', type=int, default=None)
+    parser.add_argument('-s', '--chunk_size', type=int, default=1 << 20)
+    parser.add_argument('-o', '--output', default=None)
+    args = parser.parse_args(sys.argv[1:])
+    run(args.filename, args.cmds, args.processes, args.chunk_size,
+        args.output)
@@ -21,6 +21,16 @@ types [length]:
     bfloat [4]
     bdouble [4]
     bchar [1]
+
+'n' is the fixed width of a param on the wire (in unescaped bytes), every
+byte type declares it so binary fields are read as exactly n bytes
+
+byte types also define 'fmt', the (little endian) struct format character
+used to pack and unpack the value, this allows runs of byte params to be
+decoded with a single struct.Struct
+
+numeric types define 'dtype', the name of the numpy dtype that holds
+decoded values (used for batch decoding into arrays)
 """
 
 import struct
@@ -85,36 +95,48 @@ string_from_string = lambda s: s
 
 
 types = {
-    'bool':  {'to': bool_to_string, 'from': bool_from_string, 'n': 1},
-    'int16': {'to': int16_to_string, 'from': int16_from_string},
-    'int32': {'to': int32_to_string, 'from': int32_from_string},
-    'float': {'to': float_to_string, 'from': float_from_string},
-    'double': {'to': double_to_string, 'from': double_from_string},
+    'bool':  {
+        'to': bool_to_string, 'from': bool_from_string, 'n': 1,
+        'dtype': 'bool'},
+    'int16': {
+        'to': int16_to_string, 'from': int16_from_string,
+        'dtype': 'int16'},
+    'int32': {
+        'to': int32_to_string, 'from': int32_from_string,
+        'dtype': 'int32'},
+    'float': {
+        'to': float_to_string, 'from': float_from_string,
+        'dtype': 'float64'},
+    'double': {
+        'to': double_to_string, 'from': double_from_string,
+        'dtype': 'float64'},
     'char': {'to': char_to_string, 'from': char_from_string},
     'string': {'to': string_to_string, 'from': string_from_string},
     'escaped_string': {
         'to': string_to_string, 'from': string_from_string,
         'escaped': True},
     'float_sci': {
-        'to': floatsci_to_string, 'from': floatsci_from_string},
+        'to': floatsci_to_string, 'from': floatsci_from_string,
+        'dtype': 'float64'},
     'double_sci': {
-        'to': doublesci_to_string, 'from': doublesci_from_string},
+        'to': doublesci_to_string, 'from': doublesci_from_string,
+        'dtype': 'float64'},
     # bytes
     'byte_bool': {
         'to': bool_to_bytes, 'from': bool_from_bytes, 'n': 1,
-        'escape': True},
+        'escape': True, 'fmt': '?', 'dtype': 'bool'},
     'byte_int16': {
-        'to': int16_to_bytes, 'from': int16_from_bytes,
-        'escape': True},
+        'to': int16_to_bytes, 'from': int16_from_bytes, 'n': 2,
+        'escape': True, 'fmt': 'h', 'dtype': 'int16'},
     'byte_int32': {
-        'to': int32_to_bytes, 'from': int32_from_bytes,
-        'escape': True},
+        'to': int32_to_bytes, 'from': int32_from_bytes, 'n': 4,
+        'escape': True, 'fmt': 'i', 'dtype': 'int32'},
     'byte_float': {
-        'to': float_to_bytes, 'from': float_from_bytes,
-        'escape': True},
+        'to': float_to_bytes, 'from': float_from_bytes, 'n': 4,
+        'escape': True, 'fmt': 'f', 'dtype': 'float32'},
     'byte_double': {
-        'to': double_to_bytes, 'from': double_from_bytes,
-        'escape': True},
+        'to': double_to_bytes, 'from': double_from_bytes, 'n': 4,
+        'escape': True, 'fmt': 'f', 'dtype': 'float32'},
 }
 
 # add shortcuts
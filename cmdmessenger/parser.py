@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""
+Incremental (push) parser for cmdmessenger frames
+
+Bytes are pushed in with feed as they arrive from any source (a serial
+port, socket, select loop or a recorded capture) in chunks of any size.
+Complete frames are returned as (cmd_id, fields) where fields is a list
+of bytes. Parsing state is kept between calls so separators, escapes and
+fixed width (binary) params can be split across chunks.
+
+Fields for params with 'escape' or 'escaped' are unescaped, all other
+fields are returned as received. Params with a fixed width ('n' in
+params.types) are read as exactly n (unescaped) bytes, an unescaped fs or
+ls before n bytes are read makes the frame invalid.
+"""
+
+import re
+
+from . import buffer
+from . import escaping
+
+
+def param_layout(ptypes):
+    """(n, escaped) for each param type (a params.types entry)"""
+    return tuple(
+        (pt.get('n', None), bool(pt.get('escape') or pt.get('escaped')))
+        for pt in ptypes)
+
+
+class Parser(object):
+    def __init__(self, cmds=None, fs=b',', ls=b';', esc=b'/'):
+        """cmds is a dict of cmd_id: list of params.types entries"""
+        self.fs = buffer.to_bytes(fs)
+        self.ls = buffer.to_bytes(ls)
+        self.esc = buffer.to_bytes(esc)
+        self._fsb = ord(self.fs)
+        self._lsb = ord(self.ls)
+        self._escb = ord(self.esc)
+        self.layouts = {}
+        if cmds is not None:
+            for cmd_id in cmds:
+                self.layouts[cmd_id] = param_layout(cmds[cmd_id])
+        self._pattern = re.compile(
+            b'[' + re.escape(self.fs) + re.escape(self.ls) +
+            re.escape(self.esc) + b']')
+        self.errors = 0
+        self.reset()
+
+    def reset(self):
+        """Drop any partially received frame"""
+        self._buf = bytearray()
+        self._start = 0  # start of the current field in _buf
+        self._scan = 0  # where to continue scanning in _buf
+        self._escaped = False  # current field contains escapes
+        self._cmd_id = None
+        self._layout = ()
+        self._fields = []
+        self._fixed = None  # (unescaped) bytes left in a fixed field
+        self._field = bytearray()  # reused for unescaped fixed fields
+        self._skip = False  # discarding bytes until the next ls
+
+    def clone(self):
+        """A new (reset) parser for the same commands and separators"""
+        p = Parser(None, self.fs, self.ls, self.esc)
+        p.layouts = self.layouts
+        return p
+
+    def partial(self):
+        """True if part of a frame (or an invalid frame) is buffered"""
+        return (
+            self._cmd_id is not None or self._skip or
+            bool(self._buf.strip()))
+
+    def unescape(self, s):
+        return escaping.unescape(s, self.esc)
+
+    def _next_fixed(self):
+        # set up reading of the next field if it has a fixed width
+        i = len(self._fields)
+        if i < len(self._layout) and self._layout[i][0] is not None:
+            self._fixed = self._layout[i][0]
+        else:
+            self._fixed = None
+
+    def _end_field(self, field, last):
+        # returns False if the field started an invalid (or empty) frame
+        if self._cmd_id is None:
+            field = field.strip()
+            try:
+                self._cmd_id = int(field)
+            except ValueError:
+                if field or not last:
+                    self.errors += 1
+                    self._skip = not last
+                return False
+            self._layout = self.layouts.get(self._cmd_id, ())
+            return True
+        i = len(self._fields)
+        if self._escaped and i < len(self._layout) and self._layout[i][1]:
+            field = self.unescape(field)
+        self._fields.append(field)
+        return True
+
+    def _end_frame(self, frames):
+        if self._cmd_id is not None:
+            frames.append((self._cmd_id, self._fields))
+        self._cmd_id = None
+        self._layout = ()
+        self._fields = []
+        self._fixed = None
+        del self._field[:]
+
+    def feed(self, data):
+        """Parse a chunk of bytes, return a list of complete frames"""
+        buf = self._buf
+        buf += data
+        frames = []
+        n = len(buf)
+        i = self._scan
+        fsb, lsb, escb = self._fsb, self._lsb, self._escb
+        search = self._pattern.search
+        # the view must be released before buf is resized
+        with memoryview(buf) as view:
+            while i < n:
+                if self._fixed is not None and not self._skip:
+                    # read a fixed number of (unescaped) bytes then a separator
+                    # copying runs between escapes (unescaping in one pass)
+                    field = self._field
+                    value = None
+                    short = False
+                    while self._fixed and i < n:
+                        j = min(n, i + self._fixed)
+                        m = search(buf, i, j)
+                        k = j if m is None else m.start()
+                        if k - i == self._fixed and k < n and not field:
+                            # no escapes (and the separator has arrived)
+                            # so this is the only copy of the field
+                            value = view[i:k].tobytes()
+                        else:
+                            field += view[i:k]
+                        self._fixed -= k - i
+                        i = k
+                        if i < j:  # at a separator or an esc
+                            if buf[i] != escb:
+                                short = True
+                                break
+                            if i + 1 >= n:
+                                break
+                            field.append(buf[i + 1])
+                            self._fixed -= 1
+                            i += 2
+                    if short:
+                        # byte params are escaped so an unescaped separator
+                        # means the field is short, drop the frame (resyncing
+                        # at the separator)
+                        self.errors += 1
+                        self._skip = True
+                        continue
+                    if self._fixed or i >= n:
+                        break
+                    c = buf[i]
+                    if c != fsb and c != lsb:
+                        self.errors += 1
+                        self._skip = True
+                        continue
+                    if value is None:
+                        value = bytes(field)
+                        del field[:]
+                    self._fields.append(value)
+                    i += 1
+                    self._start = i
+                    self._escaped = False
+                    if c == lsb:
+                        self._end_frame(frames)
+                    else:
+                        self._next_fixed()
+                    continue
+                m = search(buf, i)
+                if m is None:
+                    i = n
+                    break
+                j = m.start()
+                c = buf[j]
+                if c == escb:
+                    if j + 1 >= n:
+                        # the escaped byte has not arrived yet
+                        i = j
+                        break
+                    self._escaped = True
+                    i = j + 2
+                    continue
+                i = j + 1
+                if self._skip:
+                    if c == lsb:
+                        self._skip = False
+                        self._cmd_id = None
+                        self._end_frame(frames)
+                    self._start = i
+                    self._escaped = False
+                    continue
+                if self._end_field(bytes(buf[self._start:j]), c == lsb):
+                    if c == lsb:
+                        self._end_frame(frames)
+                    else:
+                        self._next_fixed()
+                self._start = i
+                self._escaped = False
+        # drop bytes of completed frames, keep the partial one
+        if self._start:
+            del buf[:self._start]
+            i -= self._start
+            self._start = 0
+        self._scan = i
+        return frames
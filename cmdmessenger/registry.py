@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Callback registry
+
+Callbacks are attached to a cmd_id (or to all commands) and an opaque
+Handle is returned that detaches the callback in O(1). For each cmd_id a
+tuple of callables is precomputed (and only rebuilt when callbacks for
+that cmd_id are attached or detached). Callbacks attached to all commands
+(cmd_id=None) are kept in one separate tuple (so attaching them does not
+touch the per command tuples) and are called with the cmd_id as the
+first argument. Dispatching a frame is:
+
+    for c in registry.dispatch[cmd_id]:
+        c(*args)
+    for c in registry.wildcards:
+        c(cmd_id, *args)
+"""
+
+
+class Handle(object):
+    """Returned by attach, pass to detach to remove the callback"""
+    def __init__(self, cmd_id, func):
+        self.cmd_id = cmd_id
+        self.func = func
+
+    def __repr__(self):
+        return "Handle(%s, %r)" % (self.cmd_id, self.func)
+
+
+class Registry(object):
+    def __init__(self, cmd_ids=()):
+        self.subscriptions = {}  # cmd_id: {handle: func}
+        self.wildcard = {}  # handle: func
+        self.wildcards = ()  # callables for all commands
+        self.dispatch = {}  # cmd_id: tuple of callables
+        for cmd_id in cmd_ids:
+            self.subscriptions[cmd_id] = {}
+            self.dispatch[cmd_id] = ()
+
+    def _rebuild(self, cmd_id):
+        if cmd_id is None:
+            self.wildcards = tuple(self.wildcard.values())
+        else:
+            self.dispatch[cmd_id] = tuple(self.subscriptions[cmd_id].values())
+
+    def handled(self, cmd_id):
+        """True if a frame for cmd_id has any callback to dispatch to"""
+        if cmd_id not in self.dispatch:
+            return False
+        return bool(self.dispatch[cmd_id] or self.wildcards)
+
+    def attach(self, func, cmd_id=None):
+        """Attach func to cmd_id (or all commands if None), return a Handle"""
+        handle = Handle(cmd_id, func)
+        if cmd_id is None:
+            self.wildcard[handle] = func
+            self._rebuild(None)
+        else:
+            if cmd_id not in self.subscriptions:
+                self.subscriptions[cmd_id] = {}
+            self.subscriptions[cmd_id][handle] = func
+            self._rebuild(cmd_id)
+        return handle
+
+    def detach(self, handle):
+        """Detach a callback by Handle (or, slowly, by function)"""
+        if not isinstance(handle, Handle):
+            for h in self.find(handle):
+                self.detach(h)
+            return
+        if handle.cmd_id is None:
+            if self.wildcard.pop(handle, None) is not None:
+                self._rebuild(None)
+        elif self.subscriptions.get(handle.cmd_id, {}).pop(
+                handle, None) is not None:
+            self._rebuild(handle.cmd_id)
+
+    def find(self, func):
+        """All handles for func (or a wrapper of func)"""
+        def match(h):
+            return h.func is func or getattr(
+                h.func, '__wrapped__', None) is func
+        handles = [h for h in self.wildcard if match(h)]
+        for subs in self.subscriptions.values():
+            handles.extend(h for h in subs if match(h))
+        return handles
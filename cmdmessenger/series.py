@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+"""
+Collect a stream of single value commands (like kReceiveSeries) into a
+numpy array
+
+Frames for a collected command are not dispatched to callbacks. Instead
+the raw fields are buffered and, once per received chunk, batch decoded
+into a growing (or preallocated) numpy array. When the terminating
+command (like kDoneReceiveSeries) arrives the collector is finished and
+its done event is set.
+
+While the parser is between frames, runs of complete frames of a
+collected command are found with one regex search (see run_patterns) and
+their fields extracted in bulk without going through the parser frame by
+frame. Fields that fail to decode are dropped (and counted as errors).
+
+    c = m.collect('kReceiveSeries', 'kDoneReceiveSeries', length=1000)
+    m.call('kRequestSeries', 1000, 0.5)
+    while not c.done.is_set():
+        m.next_command()
+    values = c.data
+"""
+
+import re
+import threading
+
+import numpy
+
+from . import buffer
+from . import escaping
+
+
+def run_patterns(head, ptype, ls=b';', esc=b'/', fs=b','):
+    """
+    Compiled regexes matching a run of (complete) frames starting with
+    head (the encoded "<id><fs>") with one ptype field each (optionally
+    followed by CR/LF) and one such frame (with the field as group 1)
+    """
+    plain = b'[^' + b''.join(
+        re.escape(c) for c in (fs, ls, esc)) + b']'
+    if 'n' in ptype:
+        value = b'(?:%s.|%s){%i}' % (re.escape(esc), plain, ptype['n'])
+    else:
+        value = plain + b'*'
+    frame = re.escape(head) + b'(' + value + b')' + re.escape(ls) + b'[\r\n]*'
+    return (
+        re.compile(b'(?:' + frame + b')+', re.S), re.compile(frame, re.S))
+
+
+class SeriesCollector(object):
+    def __init__(self, cmd, done_id=None, length=None, fs=b',', ls=b';',
+                 esc=b'/'):
+        """cmd is a resolved command dict (with 1 param)"""
+        ptypes = cmd.get('params', [])
+        if len(ptypes) != 1:
+            raise ValueError(
+                "Only commands with 1 param can be collected: %s" % cmd)
+        self.ptype = ptypes[0]
+        if 'dtype' not in self.ptype:
+            raise ValueError(
+                "Param type has no dtype and cannot be collected")
+        self.cmd_id = cmd['id']
+        self.done_id = done_id
+        self.dtype = numpy.dtype(self.ptype['dtype'])
+        if 'fmt' in self.ptype:
+            self.wire_dtype = numpy.dtype('<' + self.ptype['fmt'])
+        else:
+            self.wire_dtype = None
+        self.length = length
+        self.array = numpy.empty(
+            length if length is not None else 1024, dtype=self.dtype)
+        self.n = 0
+        self.pending = []
+        self.errors = 0  # fields that failed to decode
+        self.esc = buffer.to_bytes(esc)
+        self.run, self.frame = run_patterns(
+            buffer.to_bytes(str(self.cmd_id)) + buffer.to_bytes(fs),
+            self.ptype, buffer.to_bytes(ls), self.esc, buffer.to_bytes(fs))
+        self.done = threading.Event()
+
+    @property
+    def data(self):
+        """Values collected so far (a view, no copy)"""
+        return self.array[:self.n]
+
+    def _reserve(self, n):
+        if self.n + n <= len(self.array):
+            return
+        size = max(len(self.array) * 2, self.n + n)
+        array = numpy.empty(size, dtype=self.dtype)
+        array[:self.n] = self.array[:self.n]
+        self.array = array
+
+    def decode(self, fields):
+        """
+        Batch decode a list of (bytes) fields to an array, if any field is
+        invalid fields are decoded one at a time and invalid ones dropped
+        """
+        try:
+            return self._decode(fields)
+        except ValueError:
+            pass
+        values = []
+        for f in fields:
+            try:
+                values.append(self._decode([f])[0])
+            except ValueError:
+                self.errors += 1
+        return numpy.array(values, dtype=self.dtype)
+
+    def _decode(self, fields):
+        if self.wire_dtype is not None:
+            if any(len(f) != self.wire_dtype.itemsize for f in fields):
+                raise ValueError("Invalid field length")
+            return numpy.frombuffer(b''.join(fields), dtype=self.wire_dtype)
+        if self.dtype.kind == 'f':
+            return numpy.array(fields).astype(self.dtype)
+        # ints and bools are sent as integer text
+        values = numpy.array(fields).astype('int64')
+        return values.astype(self.dtype)
+
+    def flush(self):
+        """
+        Decode all pending fields into the array, returns the number of
+        (invalid) fields dropped
+        """
+        if not self.pending:
+            return 0
+        errors = self.errors
+        values = self.decode(self.pending)
+        self.pending = []
+        self._reserve(len(values))
+        self.array[self.n:self.n + len(values)] = values
+        self.n += len(values)
+        return self.errors - errors
+
+    def append(self, fields):
+        if fields:
+            self.pending.append(fields[0])
+
+    def extend(self, run):
+        """Add the fields of a run of frames (matched by self.run)"""
+        fields = self.frame.findall(run)
+        if self.esc in run:
+            fields = [escaping.unescape(f, self.esc) for f in fields]
+        self.pending.extend(fields)
+
+    def finish(self):
+        """Set done (call after a flush)"""
+        self.done.set()
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
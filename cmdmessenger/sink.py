@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+"""
+Columnar, memory mapped storage of received commands
+
+For every command the decoded args are stored in typed columns (one
+column per param, dtype from params.types 'dtype', params without a
+dtype like strings are skipped) plus a column of receive times. Each
+column is a .npy file in a directory:
+    <directory>/<command name>.<param index>.npy
+    <directory>/<command name>.time.npy
+
+Columns are memory mapped and grow (the file is extended) by chunk rows
+at a time so memory use stays flat however long the acquisition. Rows
+are buffered and written in batches, on flush the .npy headers are
+updated to the number of rows written so the files can be opened (zero
+copy) for analysis while they are still being written:
+
+    s = m.sink('run')  # all commands
+    ...
+    s.flush()
+    sink.load('run')['kReceiveSeries'][0] -> memmap of values
+
+Lazily decoded frames (Messenger lazy=True) are decoded when stored.
+Frames with too few (or invalid) fields for the stored columns are not
+stored (so columns stay aligned) and are counted in dropped.
+
+Captures (see capture.py) can be converted with from_capture.
+"""
+
+import os
+import struct
+import time
+
+import numpy
+
+from . import frame
+from . import stats
+
+header_size = 128  # room for the header of any shape
+
+
+def write_header(f, dtype, n):
+    """Write a (fixed size) .npy header for n rows of dtype at f[0]"""
+    d = "{'descr': %r, 'fortran_order': False, 'shape': (%i,), }" % (
+        numpy.lib.format.dtype_to_descr(dtype), n)
+    pad = header_size - 10 - len(d) - 1
+    f.seek(0)
+    f.write(
+        b'\x93NUMPY\x01\x00' + struct.pack('<H', header_size - 10) +
+        d.encode('latin-1') + b' ' * pad + b'\n')
+
+
+class Column(object):
+    """A growing, memory mapped .npy file of one dtype"""
+    def __init__(self, path, dtype, chunk=65536):
+        self.path = path
+        self.dtype = numpy.dtype(dtype)
+        self.chunk = chunk
+        self.n = 0
+        self.file = open(path, 'w+b')
+        write_header(self.file, self.dtype, 0)
+        self.array = None
+        self._resize(chunk)
+
+    def _resize(self, capacity):
+        if self.array is not None:
+            self.array.flush()
+        self.file.truncate(header_size + capacity * self.dtype.itemsize)
+        self.array = numpy.memmap(
+            self.file, dtype=self.dtype, mode='r+', offset=header_size,
+            shape=(capacity, ))
+
+    def extend(self, values):
+        n = len(values)
+        if self.n + n > len(self.array):
+            size = len(self.array)
+            while size < self.n + n:
+                size += self.chunk
+            self._resize(size)
+        self.array[self.n:self.n + n] = values
+        self.n += n
+
+    def flush(self):
+        self.array.flush()
+        write_header(self.file, self.dtype, self.n)
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.array = None
+        # drop the unused (preallocated) rows
+        self.file.truncate(header_size + self.n * self.dtype.itemsize)
+        self.file.close()
+
+
+class CommandColumns(object):
+    """Columns for one command, rows are buffered and written in batches"""
+    def __init__(self, directory, cmd, chunk=65536, batch=4096, times=True):
+        self.name = str(cmd.get('name', cmd['id']))
+        self.batch = batch
+        self.rows = []
+        self.columns = []  # (param index, Column)
+        for (i, pt) in enumerate(cmd.get('params', [])):
+            if 'dtype' not in pt:
+                continue
+            self.columns.append((i, Column(os.path.join(
+                directory, '%s.%i.npy' % (self.name, i)),
+                pt['dtype'], chunk)))
+        # rows need at least this many args to fill every column
+        self.nargs = self.columns[-1][0] + 1 if self.columns else 0
+        self.dropped = 0  # rows with too few (or invalid) args
+        self.times = None
+        if times:
+            self.times = Column(os.path.join(
+                directory, '%s.time.npy' % self.name), 'float64', chunk)
+
+    def append(self, args, t):
+        if len(args) == 1 and isinstance(args[0], frame.Frame):
+            try:
+                args = args[0].args()
+            except (ValueError, struct.error):
+                self.dropped += 1
+                return
+        if len(args) < self.nargs:
+            self.dropped += 1
+            return
+        self.rows.append((t, args))
+        if len(self.rows) >= self.batch:
+            self.write()
+
+    def write(self):
+        """Write buffered rows to the columns"""
+        rows = self.rows
+        if not rows:
+            return
+        self.rows = []
+        # convert every batch first so a bad value cannot leave
+        # the columns (and times) with different lengths
+        batches = [
+            (column, numpy.array([r[1][i] for r in rows], column.dtype))
+            for (i, column) in self.columns]
+        if self.times is not None:
+            batches.append(
+                (self.times, numpy.array([r[0] for r in rows], 'float64')))
+        for (column, values) in batches:
+            column.extend(values)
+
+    def flush(self):
+        self.write()
+        if self.times is not None:
+            self.times.flush()
+        for (_, column) in self.columns:
+            column.flush()
+
+    def close(self):
+        self.write()
+        if self.times is not None:
+            self.times.close()
+        for (_, column) in self.columns:
+            column.close()
+
+
+class ColumnSink(object):
+    def __init__(self, directory, cmds, chunk=65536, batch=4096, times=True):
+        """cmds is a dict of cmd_id: resolved command (Messenger.cmds)"""
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.directory = directory
+        self.cmds = cmds
+        self.chunk = chunk
+        self.batch = batch
+        self.times = times
+        self.commands = {}  # cmd_id: CommandColumns
+        self.start = time.time() - stats.clock()
+        self.handles = []
+        self.messenger = None
+
+    @property
+    def dropped(self):
+        """Received commands not stored (too few or invalid args)"""
+        return sum(c.dropped for c in self.commands.values())
+
+    def append(self, cmd_id, *args):
+        """Store the args of a received command (a wildcard callback)"""
+        c = self.commands.get(cmd_id, None)
+        if c is None:
+            if cmd_id not in self.cmds:
+                return  # unknown command
+            c = self.commands[cmd_id] = CommandColumns(
+                self.directory, self.cmds[cmd_id], self.chunk,
+                self.batch, self.times)
+        c.append(args, self.start + stats.clock())
+
+    def attach(self, messenger, index=None):
+        """Store every (or only index) command received by messenger"""
+        if index is None:
+            self.handles.append(messenger.attach(self.append))
+        else:
+            cmd_id = messenger.cmds[index]['id']
+            self.handles.append(messenger.attach(
+                lambda *args: self.append(cmd_id, *args), index))
+        self.messenger = messenger
+        return self
+
+    def flush(self):
+        """Write buffered rows and update headers (for readers)"""
+        for c in self.commands.values():
+            c.flush()
+
+    def close(self):
+        for h in self.handles:
+            self.messenger.detach(h)
+        self.handles = []
+        for c in self.commands.values():
+            c.close()
+        self.commands = {}
+
+
+def load(directory, mmap_mode='r'):
+    """Open columns in directory as {name: {param index or 'time': array}}"""
+    columns = {}
+    for fn in sorted(os.listdir(directory)):
+        if not fn.endswith('.npy'):
+            continue
+        name, key, _ = fn.rsplit('.', 2)
+        if key != 'time':
+            key = int(key)
+        columns.setdefault(name, {})[key] = numpy.load(
+            os.path.join(directory, fn), mmap_mode=mmap_mode)
+    return columns
+
+
+def from_capture(f, messenger, directory, **kwargs):
+    """Store the received commands of a capture file in directory"""
+    from . import capture
+    s = ColumnSink(directory, messenger.cmds, **kwargs).attach(messenger)
+    try:
+        capture.replay(f, messenger)
+    finally:
+        s.close()
+    return load(directory)
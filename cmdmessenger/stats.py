@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+"""
+Instrumentation of a Messenger (see Messenger.enable_stats)
+
+Counts bytes and frames in and out, parse errors, frames and unknown
+commands per cmd_id and keeps histograms of parse (per received chunk)
+and dispatch (per frame) times.
+
+Instrumentation is installed by replacing the feed, trigger and write
+methods on the Messenger instance with wrapped versions, so when it is
+disabled (the default) the hot path does no extra work at all. Other
+instrumentation (capture.py, latency.py) wraps methods the same way, see
+Instrument.
+
+Optional hooks (called only when enabled):
+    on_read(data): every chunk of bytes fed to the parser
+    on_write(data): every write to the stream
+    on_frame(cmd_id, args): every frame before it is dispatched
+    on_unknown(cmd_id, args): frames with no attached callback
+    on_parse_error(n): n new parse errors found in a chunk
+"""
+
+import bisect
+import collections
+import time
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def log_edges(start=1E-7, stop=10., per_decade=10):
+    """Logarithmically spaced histogram bin edges (in seconds)"""
+    edges = []
+    v = start
+    step = 10. ** (1. / per_decade)
+    while v < stop:
+        edges.append(v)
+        v *= step
+    return edges
+
+
+class Histogram(object):
+    """Fixed size (log binned) histogram of durations in seconds"""
+    def __init__(self, edges=None):
+        if edges is None:
+            edges = log_edges()
+        self.edges = edges
+        self.clear()
+
+    def clear(self):
+        self.counts = [0] * (len(self.edges) + 1)
+        self.n = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+
+    def add(self, v):
+        self.counts[bisect.bisect(self.edges, v)] += 1
+        self.n += 1
+        self.total += v
+        if self.max is None or v > self.max:
+            self.max = v
+        if self.min is None or v < self.min:
+            self.min = v
+
+    def percentile(self, p):
+        """Upper bin edge below which p percent of values fall"""
+        if not self.n:
+            return None
+        target = self.n * p / 100.
+        count = 0
+        for (i, c) in enumerate(self.counts):
+            count += c
+            if count >= target and c:
+                if i >= len(self.edges):
+                    return self.max
+                return min(self.edges[i], self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'n': self.n,
+            'mean': self.total / self.n if self.n else None,
+            'min': self.min,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'max': self.max,
+        }
+
+
+class Instrument(object):
+    """
+    Instrumentation installed by wrapping methods of a Messenger instance,
+    for each name in methods wrap_<name>(method) returns the wrapper.
+
+    The installed instruments of a messenger are kept in order (in
+    messenger._instruments). Uninstalling one restores the original
+    methods and wraps them again with the remaining instruments so, in
+    any install/uninstall order, no pass through layer is left behind.
+    """
+    methods = ()
+
+    def __init__(self, messenger):
+        self.messenger = messenger
+        self.installed = False
+
+    def install(self):
+        if self.installed:
+            return
+        self.messenger._instruments.append(self)
+        self._wrap()
+        self.installed = True
+
+    def _wrap(self):
+        m = self.messenger
+        for name in self.methods:
+            if name not in m._unwrapped:
+                m._unwrapped[name] = m.__dict__.get(name, None)
+            setattr(m, name, getattr(self, 'wrap_' + name)(getattr(m, name)))
+
+    def uninstall(self):
+        if not self.installed:
+            return
+        self.installed = False
+        m = self.messenger
+        m._instruments.remove(self)
+        for (name, f) in m._unwrapped.items():
+            if f is None:
+                m.__dict__.pop(name, None)
+            else:
+                setattr(m, name, f)
+        m._unwrapped.clear()
+        for i in m._instruments:
+            i._wrap()
+
+
+class Stats(Instrument):
+    methods = ('feed', 'trigger', 'write')
+
+    def __init__(self, messenger, on_read=None, on_write=None,
+                 on_frame=None, on_unknown=None, on_parse_error=None):
+        Instrument.__init__(self, messenger)
+        self.on_read = on_read
+        self.on_write = on_write
+        self.on_frame = on_frame
+        self.on_unknown = on_unknown
+        self.on_parse_error = on_parse_error
+        self.clear()
+
+    def clear(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.parse_errors = 0
+        self.frames = collections.Counter()
+        self.unknown = collections.Counter()
+        self.parse = Histogram()
+        self.dispatch = Histogram()
+
+    def wrap_feed(self, feed):
+        m = self.messenger
+
+        def instrumented_feed(data):
+            self.bytes_in += len(data)
+            if self.on_read is not None:
+                self.on_read(data)
+            errors = m.parser.errors
+            t0 = clock()
+            frames = feed(data)
+            self.parse.add(clock() - t0)
+            self.frames_in += len(frames)
+            errors = m.parser.errors - errors
+            if errors:
+                self.parse_errors += errors
+                if self.on_parse_error is not None:
+                    self.on_parse_error(errors)
+            return frames
+        return instrumented_feed
+
+    def wrap_trigger(self, trigger):
+        m = self.messenger
+
+        def instrumented_trigger(cmd_id, *args):
+            self.frames[cmd_id] += 1
+            if self.on_frame is not None:
+                self.on_frame(cmd_id, args)
+            if not m.registry.handled(cmd_id):
+                self.unknown[cmd_id] += 1
+                if self.on_unknown is not None:
+                    self.on_unknown(cmd_id, args)
+            t0 = clock()
+            trigger(cmd_id, *args)
+            self.dispatch.add(clock() - t0)
+        return instrumented_trigger
+
+    def wrap_write(self, write):
+        def instrumented_write(data, nframes=1):
+            self.bytes_out += len(data)
+            self.frames_out += nframes
+            if self.on_write is not None:
+                self.on_write(data)
+            write(data, nframes)
+        return instrumented_write
+
+    def snapshot(self):
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'frames_in': self.frames_in,
+            'frames_out': self.frames_out,
+            'parse_errors': self.parse_errors,
+            'frames': dict(self.frames),
+            'unknown': dict(self.unknown),
+            'parse': self.parse.summary(),
+            'dispatch': self.dispatch.summary(),
+        }
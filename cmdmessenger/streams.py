@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+"""
+In-memory streams with the parts of the pyserial interface used by
+Messenger (read, write, in_waiting, timeout)
+
+    a, b = streams.pair()
+    a.write(b'1;')
+    b.read(2) -> b'1;'
+
+FdStream wraps a file descriptor (for example the master side of a pty)
+"""
+
+import os
+import select
+import struct
+import threading
+
+try:
+    import fcntl
+    import termios
+except ImportError:  # not available on windows
+    fcntl = None
+
+
+class Pipe(object):
+    """One direction of an in-memory byte stream (thread safe)"""
+    def __init__(self):
+        self.buffer = bytearray()
+        self.condition = threading.Condition()
+        self.closed = False
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def write(self, data):
+        with self.condition:
+            self.buffer += data
+            self.condition.notify_all()
+        return len(data)
+
+    def read(self, n, timeout=None):
+        """Read up to n bytes, waiting up to timeout for at least 1"""
+        with self.condition:
+            if not self.buffer and not self.closed:
+                self.condition.wait(timeout)
+            data = bytes(self.buffer[:n])
+            del self.buffer[:n]
+        return data
+
+    def readinto(self, out, timeout=None):
+        """Read up to len(out) bytes into out, waiting up to timeout"""
+        with self.condition:
+            if not self.buffer and not self.closed:
+                self.condition.wait(timeout)
+            n = min(len(out), len(self.buffer))
+            out[:n] = self.buffer[:n]
+            del self.buffer[:n]
+        return n
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class LoopbackStream(object):
+    def __init__(self, rx, tx, timeout=None):
+        self.rx = rx
+        self.tx = tx
+        self.timeout = timeout
+
+    @property
+    def in_waiting(self):
+        return len(self.rx)
+
+    def inWaiting(self):
+        return len(self.rx)
+
+    def read(self, n=1):
+        return self.rx.read(n, self.timeout)
+
+    def readinto(self, out):
+        return self.rx.readinto(out, self.timeout)
+
+    def write(self, data):
+        return self.tx.write(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.tx.close()
+
+
+def pair(timeout=None):
+    """Two connected streams, bytes written to one are read from the other"""
+    ab = Pipe()
+    ba = Pipe()
+    return (
+        LoopbackStream(ba, ab, timeout),
+        LoopbackStream(ab, ba, timeout))
+
+
+class FdStream(object):
+    """Stream reading and writing a file descriptor (for example a pty)"""
+    def __init__(self, fd, timeout=None):
+        self.fd = fd
+        self.timeout = timeout
+
+    def fileno(self):
+        return self.fd
+
+    @property
+    def in_waiting(self):
+        if fcntl is None:
+            return 0
+        n = fcntl.ioctl(self.fd, termios.FIONREAD, b'\x00\x00\x00\x00')
+        return struct.unpack('I', n)[0]
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def read(self, n=1):
+        r, _, _ = select.select([self.fd], [], [], self.timeout)
+        if not r:
+            return b''
+        return os.read(self.fd, n)
+
+    def readinto(self, out):
+        r, _, _ = select.select([self.fd], [], [], self.timeout)
+        if not r:
+            return 0
+        return os.readv(self.fd, [out])
+
+    def write(self, data):
+        view = memoryview(data)
+        while len(view):
+            view = view[os.write(self.fd, view):]
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        os.close(self.fd)
@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 
-import serial
+import time
 
+from . import buffer
+from . import escaping
+from . import messagelog
 from . import messenger
 from . import params
+from . import streams
 
 cmds = [
     {'name': 'kCommError'},  # 0
@@ -121,7 +125,7 @@ ppvalues = {
     'kDouble': [0., -1., 1., -1E-1, 1E-1, -1E2, 1E2],
     'kDoubleSci': [0., -1., 1., -1E-1, 1E-1, -1E2, 1E2],
     #'kChar': [chr(0), chr(128), chr(255), ',', ';', '\n', '\r', '\\'],
-    'kChar': [chr(0), chr(128), chr(255), '/', '\n', '\r'],
+    'kChar': [chr(0), chr(128), chr(255), '\n', '\r'],
     #'kString': ['hi', 'hello', 'how are things', '\x00\\\r\n,;'],
     'kString': ['hi', 'hello', 'how are things'],
 }
@@ -133,37 +137,37 @@ ppvalues['kBDouble'] = ppvalues['kDouble']
 
 
 def setup(port='/dev/ttyUSB0'):
+    import serial
     s = serial.Serial(port, 115200)
     return messenger.Messenger(s, cmds)
 
 
-def wrap(f, cmd_id):
-    def wrapped(*args):
-        f(cmd_id, *args)
-    return wrapped
+def emulated(timeout=1., **kwargs):
+    """
+    Messenger connected (in memory) to an emulated CmdMessengerTest board
+    kwargs are passed to emulator.Emulator (baud, latency, jitter...)
+    """
+    from . import emulator
+    a, b = streams.pair(timeout=timeout)
+    emulator.Emulator(b, **kwargs).start()
+    return messenger.Messenger(a, cmds)
 
 
 class Expect(object):
-    def __init__(self, messenger):
+    def __init__(self, messenger, capacity=10000, policy='oldest'):
         self.messenger = messenger
         self.last_message = None
-        self.messages = []
+        # bounded (see messagelog.py) so long runs do not grow memory
+        self.messages = messagelog.MessageLog(capacity, policy)
         self.callbacks = []
         self.attach_callbacks()
 
     def attach_callbacks(self):
-        for c in self.messenger.cmds:
-            cmd_id = self.messenger.cmds[c]['id']
-            self.callbacks.append(
-                self.messenger.attach(wrap(self.log, cmd_id), cmd_id))
-            #self.callbacks.append(self.messenger.attach(
-            #    lambda f=self.log, cmd_id=cmd_id, *args: f(cmd_id, *args),
-            #    cmd_id))
+        # log is called for every command as log(cmd_id, *args)
+        self.callbacks.append(self.messenger.attach(self.log))
 
     def log(self, cmd_id, *args):
-        msg = {'id': cmd_id, 'args': args}
-        self.last_message = msg
-        self.messages.append(msg)
+        self.last_message = self.messages.append(cmd_id, args)
 
     def update(self):
         self.messenger.next_command()
@@ -231,27 +235,6 @@ def eq(a, b):
     return a == b
 
 
-def escape(s, chars, esc):
-    r = ""
-    for c in s:
-        if c in chars:
-            r += esc
-        r += c
-    return r
-
-
-def unescape(s, esc='/'):
-    r = ""
-    e = False
-    for c in s:
-        if not e and c == esc:
-            e = True
-        else:
-            r += c
-            e = False
-    return r
-
-
 def value_tests(m):
     expect = Expect(m)
     for (ti, pptype) in enumerate(pptypes):
@@ -261,13 +244,14 @@ def value_tests(m):
             ptype = params.types[t]
             ev = ptype['to'](v)
             if ptype.get('escape', False):
-                ev = escape(ev, m.ls + m.fs + '\x00', m.esc)
+                ev = escaping.escape(ev, m.fs, m.ls, m.esc)
             m.call('kValuePing', ti, ev)
             #expect('kValuePong', ev)
             expect('kValuePong')
             # decode value
             if ptype.get('escape', False):
-                rv = unescape(expect.last_message['args'][0], m.esc)
+                rv = buffer.to_bytes(escaping.unescape(
+                    expect.last_message['args'][0], m.esc))
             else:
                 rv = expect.last_message['args'][0]
             dv = ptype['from'](rv)
@@ -279,12 +263,351 @@ def value_tests(m):
 
 def multiple_arguments_tests(m):
     # ->kMultiValuePing <-kMultiValuePong
-    pass
+    expect = Expect(m)
+    for args in [
+            (0, 0, 0.), (-32767, 2147483647, 1.), (32767, -2147483647, -1.),
+            (128, -256, 100.)]:
+        m.call('kMultiValuePing', *args)
+        expect('kMultiValuePong', *args)
+    print("kMultiValuePing test passed")
+    expect.detach_callbacks()
 
 
-def transfer_speed_tests(m):
+def transfer_speed_tests(m, n=10000):
     # send series of N [10000] floats, benchmark transfer speed
-    pass
+    expect = Expect(m)
+    t0 = time.time()
+    m.call('kRequestSeries', n, 0.5)
+    for i in range(n):
+        expect('kReceiveSeries', i * 0.5)
+    expect('kDoneReceiveSeries')
+    t = time.time() - t0
+    print("kRequestSeries received %s values in %.3f s [%.0f/s]" % (
+        n, t, n / t))
+    t0 = time.time()
+    m.call('kPrepareSendSeries', n)
+    m.call_many('kSendSeries', [i * 0.5 for i in range(n)])
+    expect('kAckSendSeries')
+    t = time.time() - t0
+    print("kSendSeries sent %s values in %.3f s [%.0f/s]" % (n, t, n / t))
+    expect.detach_callbacks()
+
+
+parser_cmds = [
+    {'name': 'kNone'},  # 0
+    {'name': 'kText', 'params': ['s', 'i16']},  # 1
+    {'name': 'kEscaped', 'params': ['es']},  # 2
+    {'name': 'kFixed', 'params': ['bi16', 'bf']},  # 3
+    {'name': 'kBInt16', 'params': ['bi16']},  # 4
+    {'name': 'kBFloat', 'params': ['bf']},  # 5
+]
+
+
+def parse_chunks(data, sizes):
+    """Frames (and errors) parsing data split into chunks of sizes"""
+    m = messenger.Messenger(None, parser_cmds)
+    frames = []
+    i = 0
+    for n in sizes:
+        frames.extend(m.feed(data[i:i + n]))
+        i += n
+    frames.extend(m.feed(data[i:]))
+    return frames, m.parser.errors
+
+
+def check_parse(data, expected, errors=0):
+    # every split of data into 2 chunks and byte at a time
+    splits = [[]] + [[i] for i in range(1, len(data))] + [[1] * len(data)]
+    for sizes in splits:
+        frames, e = parse_chunks(data, sizes)
+        if frames != expected or e != errors:
+            raise Exception("%r split %s: %s [%s errors] != %s [%s errors]" % (
+                data, sizes, frames, e, expected, errors))
+
+
+def parser_tests():
+    m = messenger.Messenger(None, parser_cmds)
+    fixed = m.encoders['kFixed'](-2, 0.5)
+    check_parse(b'0;1,hi,3;', [(0, []), (1, ['hi', 3])])
+    # fs is only sent when at least one arg is encoded
+    frames = [m.encoders['kText'](), m.encoders['kText']('hi')]
+    if frames != [b'1;', b'1,hi;']:
+        raise Exception("encoded %s" % (frames, ))
+    # chunks can be any buffer
+    for chunk in (b'0;', bytearray(b'0;'), memoryview(b'0;'), '0;'):
+        if m.feed(chunk) != [(0, [])]:
+            raise Exception("feed(%r) failed" % (chunk, ))
+    print("parser separators test passed")
+    # escaped separators (and escaped escapes) split across chunks
+    check_parse(b'2,a/,b/;c//;2,/;;', [(2, ['a,b;c/']), (2, [';'])])
+    print("parser escapes test passed")
+    # fixed width fields containing escaped bytes
+    if escaping.escape(b'\x00') not in m.encoders['kFixed'](0, 0.):
+        raise Exception("kFixed(0, 0.) should contain escaped bytes")
+    check_parse(
+        fixed + m.encoders['kFixed'](0, 0.),
+        [(3, [-2, 0.5]), (3, [0, 0.])])
+    print("parser fixed width test passed")
+    # CR/LF between frames
+    check_parse(b'0;\r\n1,a,1;\r\n' + fixed + b'\n', [
+        (0, []), (1, ['a', 1]), (3, [-2, 0.5])])
+    print("parser CR/LF test passed")
+    # resync after invalid frames
+    check_parse(b'x,1;1,a,b;0;', [(0, [])], 2)
+    # unescaped separators in fixed width fields
+    check_parse(b'3,;1,hi,1;' + fixed, [(1, ['hi', 1]), (3, [-2, 0.5])], 1)
+    check_parse(b'3,a,b;0;3,ab,;0;', [(0, []), (0, [])], 2)
+    print("parser resync test passed")
+    # process_line parses lines on their own
+    received = []
+    m.attach(lambda *args: received.append(args), 'kText')
+    m.feed(b'1,par')
+    m.process_line('1,hello,1')
+    m.process_line('1,world,2;\r\n')
+    frames = m.feed(b'tial,3;')
+    if received != [('hello', 1), ('world', 2)]:
+        raise Exception("process_line received %s" % (received, ))
+    if frames != [(1, ['partial', 3])]:
+        raise Exception("process_line broke a partial frame: %s" % frames)
+    print("parser process_line test passed")
+
+
+def collect_tests():
+    m = messenger.Messenger(None, cmds)
+    data = b'14,1.5;14,abc;14,2;\r\n14,;15,done;14,3;'
+    for sizes in ([], [1] * len(data), [9, 9]):
+        m.parser.reset()
+        m.parser.errors = 0
+        c = m.collect('kReceiveSeries', 'kDoneReceiveSeries')
+        frames = []
+        i = 0
+        for n in sizes + [len(data)]:
+            frames.extend(m.feed(data[i:i + n]))
+            i += n
+        if list(c.data) != [1.5, 2.] or not c.done.is_set():
+            raise Exception("collected %s [done %s]" % (
+                c.data, c.done.is_set()))
+        if frames != [(15, ['done']), (14, [3.])] or m.parser.errors != 2:
+            raise Exception("collect frames %s [%s errors]" % (
+                frames, m.parser.errors))
+    print("collect invalid fields test passed")
+
+
+def encode_tests():
+    import struct
+    import numpy
+    m = messenger.Messenger(None, parser_cmds)
+    for name, values in (
+            ('kBInt16', [0, 1, -1, 59, 32767, -32768]),
+            ('kBFloat', [0., -1.5, 1E30, float('inf')])):
+        e = m.encoders[name]
+        expected = b''.join(e(v) for v in values)
+        if e.encode_many(numpy.array(values)) != expected:
+            raise Exception("%s encode_many(%s) != %r" % (
+                name, values, expected))
+    # arrays raise (like single values) instead of wrapping or truncating
+    for name, values in (
+            ('kBInt16', [1, 70000]), ('kBInt16', [1.5]),
+            ('kBFloat', [1E40])):
+        for v in (values, numpy.array(values)):
+            try:
+                m.encoders[name].encode_many(v)
+            except (struct.error, OverflowError):
+                continue
+            raise Exception("%s encode_many(%r) did not raise" % (name, v))
+    print("encode_many test passed")
+    # command stubs send the same frames as the encoders
+    sent = []
+    m.write = sent.append
+    for (name, args) in (
+            ('kNone', ()), ('kText', ()), ('kText', ('a', )),
+            ('kText', ('a', 2)), ('kFixed', (-2, )), ('kFixed', (-2, 0.5))):
+        getattr(m.cmd, name)(*args)
+        if sent.pop() != m.encoders[name](*args):
+            raise Exception("m.cmd.%s%s != encoder" % (name, args))
+    print("command stub test passed")
+
+
+def dispatch_tests():
+    import contextlib
+    import io
+    m = messenger.Messenger(None, cmds)
+    received = []
+
+    def fail(*args):
+        raise ValueError("callback failed")
+
+    m.attach(fail, 'kComment')
+    m.attach(lambda *args: received.append(args), 'kAcknowledge')
+    with contextlib.redirect_stderr(io.StringIO()):
+        for (cmd_id, args) in m.feed(b'1;2,a;1;'):
+            m.dispatch(cmd_id, args)
+    if m.callback_errors != 2 or received != [('a', )]:
+        raise Exception("dispatch %s [%s errors]" % (
+            received, m.callback_errors))
+    print("dispatch callback errors test passed")
+
+
+def flow_tests():
+    from . import emulator
+    from . import flow
+    # a silent peer: every try times out then the request fails
+    a, b = streams.pair(timeout=0.01)
+    m = messenger.Messenger(a, cmds)
+    w = m.window(size=2, timeout=0.02, retries=2)
+    r = w.send('kAreYouReady', 'kAcknowledge')
+    try:
+        r.wait(1.)
+    except flow.AckTimeout:
+        pass
+    else:
+        raise Exception("request to a silent peer did not time out")
+    sent = b.read(100)
+    if (r.tries, w.retransmits, w.failed, w.inflight) != (3, 2, 1, []) or \
+            sent != m.encoders['kAreYouReady']() * 3:
+        raise Exception("silent peer: %s tries, %s [%r]" % (
+            r.tries, w.snapshot(), sent))
+    print("flow ack timeout test passed")
+    # acks complete requests in order, stray acks are unmatched
+    a, b = streams.pair(timeout=0.01)
+    e = emulator.Emulator(b).start()
+    m = messenger.Messenger(a, cmds)
+    w = m.window(size=4, timeout=1.)
+    requests = [w.send('kAreYouReady', 'kAcknowledge') for _ in range(10)]
+    if not w.flush(5.):
+        raise Exception("flush timed out: %s" % (w.snapshot(), ))
+    if [r.result for r in requests] != [('Arduino ready', )] * 10 or \
+            (w.acked, w.retransmits) != (10, 0):
+        raise Exception("acks: %s" % (w.snapshot(), ))
+    m.dispatch(m.cmds['kAcknowledge']['id'], ['late'])
+    if w.unmatched != 1:
+        raise Exception("stray ack: %s" % (w.snapshot(), ))
+    print("flow ack matching test passed")
+    # series: prepare, n items and one ack per series
+    series = [w.series([0.5 * i for i in range(n)]) for n in (1, 10, 100)]
+    if [r.wait(5.) for r in series] != [('Received series', )] * 3:
+        raise Exception("series: %s" % (w.snapshot(), ))
+    w.close()
+    e.stop()
+    print("flow series test passed")
+
+
+def parallel_tests():
+    import os
+    import tempfile
+    from . import capture
+    from . import parallel
+    m = messenger.Messenger(None, parser_cmds)
+    data = b''.join(
+        m.encoders['kFixed'](i, 0.) + m.encoders['kEscaped']('a;b/,' * i) +
+        m.encoders['kBInt16'](59) + b'x;' for i in range(100))
+    expected = parallel.decode(
+        data, parser_cmds, processes=0, chunk_size=len(data))
+    directory = tempfile.mkdtemp()
+    raw = os.path.join(directory, 'raw.bin')
+    with open(raw, 'wb') as f:
+        f.write(data)
+    # received bytes split over records with sent bytes between them
+    cap = os.path.join(directory, 'run.cap')
+    with open(cap, 'wb') as f:
+        f.write(capture.magic + capture.header.pack(0.))
+        for i in range(0, len(data), 7):
+            f.write(capture.record.pack(0., capture.TX, 2) + b'0;')
+            f.write(capture.record.pack(0., capture.RX, len(data[i:i + 7])))
+            f.write(data[i:i + 7])
+    for path in (raw, cap):
+        for chunk_size in (64, 1000, 1 << 20):
+            r = parallel.decode(
+                path, parser_cmds, processes=0, chunk_size=chunk_size)
+            if r != expected:
+                raise Exception("decode %s in %s byte chunks: %s != %s" % (
+                    path, chunk_size, r[1], expected[1]))
+    print("parallel decode ranges test passed")
+
+
+def sink_tests():
+    import tempfile
+    from . import sink
+    for lazy in (False, True):
+        m = messenger.Messenger(None, cmds, lazy=lazy)
+        directory = tempfile.mkdtemp()
+        s = m.sink(directory, batch=2)
+        for (cmd_id, args) in m.feed(
+                b'9,1,2,0.5;9,7;10,1,2,3;9,3,4,1.5;9,x,1,1;9,5,6,2.5;'):
+            m.trigger(cmd_id, *args)
+        dropped = s.dropped
+        s.close()
+        columns = sink.load(directory)['kMultiValuePing']
+        values = [list(columns[i]) for i in range(3)]
+        # eagerly decoded frames with an invalid field never reach
+        # the sink, lazy ones are dropped by it
+        if values != [[1, 3, 5], [2, 4, 6], [.5, 1.5, 2.5]] or \
+                len(columns['time']) != 3 or dropped != 1 + lazy:
+            raise Exception("lazy=%s sink %s %s [%s dropped]" % (
+                lazy, values, len(columns['time']), dropped))
+    print("sink column alignment test passed")
+
+
+def compiler_tests():
+    import json
+    import os
+    import tempfile
+    from . import compiler
+    source = """
+    enum {
+        kNone,  // comment, kNotACommand
+        kMixed = 2, /* kNorThis */
+        kText,
+    };
+    """
+    spec = compiler.from_enum(
+        source, {'kMixed': ['s', 'bi16', 'bf', 'i32', 'bd', 'es'],
+                 'kText': [str, int]}, {'kMixed': 'kText'})
+    names = [c.get('name') for c in spec['commands']]
+    if names != ['kNone', None, 'kMixed', 'kText'] or \
+            spec['commands'][2]['reply'] != 'kText':
+        raise Exception("from_enum %s" % (spec, ))
+    print("compiler enum test passed")
+    # a cache miss writes the module, hits reuse it (in and across processes)
+    cache_dir = tempfile.mkdtemp()
+    filename = os.path.join(cache_dir, 'spec.json')
+    with open(filename, 'w') as f:
+        json.dump(compiler.load_spec(spec), f)
+    table = compiler.compile_table(filename, cache_dir)
+    path = os.path.join(
+        cache_dir, 'cmdmessenger_table_%s.py' % table.spec_hash)
+    mtime = os.stat(path).st_mtime
+    if compiler.compile_table(filename, cache_dir) is not table or \
+            compiler.compile_table(spec, cache_dir) is not table:
+        raise Exception("compiled table was not reused")
+    del compiler._tables[table.spec_hash]
+    generate = compiler.generate
+    compiler.generate = None  # a miss would fail
+    try:
+        loaded = compiler.compile_table(spec, cache_dir)
+    finally:
+        compiler.generate = generate
+    if loaded is table or loaded.spec_hash != table.spec_hash or \
+            os.stat(path).st_mtime != mtime:
+        raise Exception("compiled table was not loaded from the cache")
+    print("compiler cache test passed")
+    # generated stubs and decoders match the interpreted codecs
+    m = messenger.Messenger.from_spec(None, filename, cache_dir)
+    r = messenger.Messenger(None, spec['commands'])
+    args = ['ab', -2, 0.5, 70000, 1.25, 'c;d/']
+    sent = []
+    m.write = sent.append
+    m.cmd.kMixed(*args)
+    m.cmd.kMixed('a', 1)
+    m.cmd.kText('x', 3)
+    data = b''.join(sent)
+    if data != r.encoders['kMixed'](*args) + r.encoders['kMixed']('a', 1) + \
+            r.encoders['kText']('x', 3):
+        raise Exception("compiled commands sent %r" % (data, ))
+    frames = m.feed(data)
+    if frames != r.feed(data) or frames[0] != (2, args):
+        raise Exception("compiled decoders %s != %s" % (frames, r.feed(data)))
+    print("compiler round trip test passed")
 
 
 def run(m):
@@ -299,3 +622,31 @@ def run(m):
 def test():
     m = setup()
     run(m)
+
+
+def emulator_tests(m):
+    expect = Expect(m)
+    # missing args make the handler raise, the emulator replies kError
+    m.call('kPrepareSendSeries')
+    expect('kError')
+    m.call('kAreYouReady')
+    expect('kAcknowledge')
+    expect.detach_callbacks()
+    print("emulator handler error test passed")
+
+
+def test_emulated(**kwargs):
+    m = emulated(**kwargs)
+    run(m)
+    emulator_tests(m)
+
+
+def test_parser():
+    parser_tests()
+    encode_tests()
+    dispatch_tests()
+    collect_tests()
+    parallel_tests()
+    sink_tests()
+    compiler_tests()
+    flow_tests()
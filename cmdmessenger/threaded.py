@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+"""
+Background reader thread with a configurable callback dispatcher
+
+The reader thread only reads from the stream and parses frames, so slow
+callbacks cannot stall reads (and overflow the OS serial buffer).
+Decoded frames are handed to a Dispatcher which runs callbacks:
+    'inline': on the reader thread (same as Messenger.next_command)
+    'single': on one worker thread
+    'pool': on a pool of worker threads, all frames for a cmd_id go to
+        the same worker so callbacks for a command stay in order
+
+Workers are fed through bounded queues, when a queue is full the reader
+blocks (and data backs up into the stream buffer).
+
+    m.start_reader('pool', workers=4)
+    ...
+    m.stop_reader()
+"""
+
+import threading
+
+try:
+    import queue
+except ImportError:  # python 2
+    import Queue as queue
+
+from . import buffer
+
+
+_stop = object()
+
+
+class Dispatcher(object):
+    def __init__(self, dispatch, mode='inline', workers=1, queue_size=1024):
+        """
+        dispatch is called (on a worker) with (cmd_id, args) and handles
+        callback errors (see Messenger.dispatch)
+        """
+        if mode not in ('inline', 'single', 'pool'):
+            raise ValueError("Unknown dispatch mode %s" % mode)
+        self.trigger = dispatch
+        self.mode = mode
+        if mode == 'inline':
+            workers = 0
+        elif mode == 'single':
+            workers = 1
+        self.queues = [queue.Queue(queue_size) for _ in range(workers)]
+        self.threads = []
+        for q in self.queues:
+            t = threading.Thread(target=self._work, args=(q, ))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def _work(self, q):
+        while True:
+            frame = q.get()
+            if frame is _stop:
+                break
+            self.trigger(*frame)
+
+    def dispatch(self, cmd_id, args):
+        if not self.queues:
+            self.trigger(cmd_id, args)
+        else:
+            self.queues[cmd_id % len(self.queues)].put((cmd_id, args))
+
+    def stop(self, timeout=None):
+        """Stop workers after all queued frames are dispatched"""
+        for q in self.queues:
+            q.put(_stop)
+        for t in self.threads:
+            t.join(timeout)
+
+
+class ThreadedReader(object):
+    def __init__(self, messenger, dispatcher):
+        self.messenger = messenger
+        self.dispatcher = dispatcher
+        self._running = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self._read)
+        self.thread.daemon = True
+
+    def start(self):
+        self._running.set()
+        self.thread.start()
+        return self
+
+    def _read(self):
+        m = self.messenger
+        dispatch = self.dispatcher.dispatch
+        while self._running.is_set():
+            try:
+                if not len(m.rx):
+                    m.rx.fill()
+                frames = m.feed(m.rx.drain())
+            except buffer.ReadTimeout:
+                continue
+            except Exception as e:
+                # stream closed or failed, stop reading
+                self.error = e
+                self._running.clear()
+                break
+            for (cmd_id, args) in frames:
+                dispatch(cmd_id, args)
+
+    def stop(self, timeout=None):
+        """
+        Stop reading (the reader exits after the current stream read
+        returns) and wait for queued callbacks
+        """
+        self._running.clear()
+        if self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+        self.dispatcher.stop(timeout)